@@ -21,12 +21,25 @@ from __future__ import (unicode_literals, division)
 
 from xml.sax.saxutils import escape
 
+import threading
 import time
+import sys
+import os
 import re
 
+if sys.version_info[0] >= 3:
+    from urllib.request import ProxyHandler
+else:
+    from urllib2 import ProxyHandler
+
 from .netbib.utils import metadata_distance
-from .tags import msc_tags, arxiv_tags
+from .netbib.xref import get_map
+from .netbib.replay import browser_from_env
+from .netbib.transport import build_opener
+from .tags import subject_tags
 
+from calibre import get_proxies
+from calibre.constants import config_dir
 from calibre.utils.browser import Browser
 from calibre.ebooks.metadata.sources.base import Source, Option
 from calibre.ebooks.metadata.book.base import Metadata
@@ -49,40 +62,103 @@ class MySource(Source):
     idkey = None
     maxresults = 5
     sleep_time = 0.5
+    grace_time = 2
     worker_class = None
+    stream_results = True
+    worker = None
+    worker_lock = threading.Lock()
+    xref_file = 'netbib-xref.sqlite'
+    xref_keys = ['arxiv', 'mr', 'zbl']
     abstract_title = None
 
     def identify(self, log, result_queue, abort, title=None, authors=None,
               identifiers={}, timeout=30):
 
-        md = self.worker_class(self.browser, timeout)
-
         d = {}
         idval = identifiers.get(self.idkey, None)
         isbn = identifiers.get('isbn', None)
+        doi = identifiers.get('doi', None)
 
         if idval: d['id'] = idval
         if isbn: d['isbn'] = isbn
+        if doi: d['doi'] = doi
+
+        # Identifiers from other sources, to look up in the cross reference map
+        for k in self.xref_keys:
+            if k != self.idkey and identifiers.get(k, None):
+                d[k] = identifiers[k]
         if title: d['title'] = title
         if authors: d['authors'] = authors
 
-        md.query(d, maxresults = self.maxresults)
+        # Results are forwarded as soon as they are parsed, and ranked by
+        # identify_results_keygen. Only the first maxresults are forwarded, as the rest
+        # would mostly be trimmed. A Metadata is never changed once it is in the queue,
+        # so results that gain an abstract later are put again, and calibre merges them.
+        streamed = {}
+        lock = threading.Lock()
+
+        def forward(item):
+            with lock:
+                if abort.is_set() or len(streamed) >= self.maxresults: return
+                streamed[item.get('id', id(item))] = 'abstract' in item
+            result_queue.put(self.item2mi(item))
+
+        # Past the deadline the query returns what it has, so it should be done soon
+        # after it. If it is not done grace_time seconds later, it is abandoned.
+        deadline = time.time() + timeout
+        on_result = forward if self.stream_results else None
+        md = self.get_worker().query(d, maxresults = self.maxresults, timeout = timeout,
+                                     on_result = on_result, deadline = deadline)
+        done = md.wait(timeout = max(0, deadline - time.time()) + self.grace_time, abort=abort)
+
+        if abort.is_set():
+            md.cancel()
+            return None
+
+        if not done:
+            md.cancel()
+            log.warn('%s did not finish in time, giving up' % self.name)
+            return None
+
+        if md.error:
+            log.error('Error querying %s: %s' % (self.name, md.error))
+
+        if md.expired:
+            log.warn('%s ran out of time, returning partial results' % self.name)
+
+        if md.plan:
+            log.info('%s found results with the %s plan' % (self.name, md.plan))
+
+        log.debug('Stats for %s' % md.stats.summary())
+
+        with lock:
+            for item in md.ans:
+                key = item.get('id', id(item))
+                if key in streamed and (streamed[key] or not 'abstract' in item): continue
+                result_queue.put(self.item2mi(item))
+
+        return None
 
-        while not abort.is_set():
-            md.join(0.2)
-            if abort.is_set(): break
-            if not md.is_alive(): break
 
-        time.sleep(self.sleep_time)
+    def item2mi(self, item):
+        """Converts an answer from the worker into a Metadata object for the queue"""
+        mi = self.data2mi(item)
+        mi.isbn = check_isbn(mi.isbn)
+        return mi
 
-        if not abort.is_set():
-            for i in range(0,len(md.ans)):
-                mi = self.data2mi(md.ans[i])
-                mi.source_relevance = i                # Less means more relevant.
-                mi.isbn = check_isbn(mi.isbn)
 
-                result_queue.put(mi)
-        return None
+    def get_worker(self):
+        """Returns the netbib worker of this source. It is created once and shared by
+           all identify calls, so that its state survives across queries. Requests go
+           through netbib's opener, with the proxies and headers of the calibre browser,
+           so that an aborted identify also aborts the connections it is opening."""
+        with MySource.worker_lock:
+            if self.worker is None:
+                opener = build_opener(ProxyHandler(get_proxies()))
+                opener.addheaders = list(self.browser.addheaders)
+                self.worker = self.worker_class(browser_from_env(opener))
+                self.worker.xref = get_map(os.path.join(config_dir, self.xref_file))
+            return self.worker
 
 
     def identify_results_keygen(self, title=None, authors=None, identifiers={}):
@@ -104,7 +180,7 @@ class MySource(Source):
 
         # Regular metadata
         mi.title = item.get('title', None)
-        mi.authors = item.get('authors', [])
+        mi.authors = list(item.get('authors', []))
         mi.publisher = item.get('publisher', None)
 
         if 'id' in item.keys(): mi.set_identifier(self.idkey, item['id'])
@@ -128,12 +204,7 @@ class MySource(Source):
             mi.series_index = self.format_series_index(item.get('volume'), item.get('number'))
 
         if 'subject' in item.keys():
-            tags = set([])
-            for s in item['subject']:
-                tags.update(msc_tags(s))
-                tags.update(arxiv_tags(s))
-
-            mi.tags = list(sorted(tags))
+            mi.tags = list(sorted(subject_tags(item['subject'])))
 
         return mi
 
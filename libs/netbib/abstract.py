@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import (unicode_literals, division)
+
+import re
+
+# Conversion of the html of a review, as the sources publish it, into the html of the
+# calibre comments: one <p> per paragraph, with the markup the source uses for italics
+# and the like mapped to plain tags. The review is scanned once, token by token, from
+# the opening of its <div> to the first </div>. Given the raw response, only the review
+# is decoded.
+#
+#   >>> convert = Converter('<div class="review">', '<br\s*/>\s*&nbsp;\s*&nbsp;',
+#   ...                     tags={('span', 'class="it"'): ('<i>', '</i>')})
+#   >>> convert('<div class="review">An <span class="it">example</span>.</div>')
+#   '<p>An <i>example</i>.</p>'
+
+whitespace = re.compile('\s+')
+
+
+
+class Converter(object):
+    """Converts the review inside the div opened by start into calibre comment html.
+       Paragraphs are split at matches of separator. A tag in tags, keyed by name and
+       attributes, is replaced by the pair (open, close) of strings, and the contents
+       of a tag in skip are dropped. The whole review is rejected when a tag in reject
+       appears. Other tags are kept as they are."""
+
+    def __init__(self, start, separator, tags=None, skip=(), reject=()):
+        self.start = start
+        self.bstart = start.encode('utf-8')
+        self.tags = tags or {}
+        self.skip = frozenset(skip)
+        self.reject = frozenset(reject)
+        self.names = frozenset(name for name, attrs in self.tags)
+
+        self.tokens = re.compile('(?P<sep>%s)|<(?P<close>/?)(?P<name>\w+)(?P<attrs>[^>]*)>'
+                                 '|(?P<text>[^<\n]+|[<\n])' % separator)
+
+
+    def __call__(self, rawdata):
+        """Returns the review in rawdata, a page as text or utf-8 bytes, as html
+           paragraphs, or None"""
+        if isinstance(rawdata, bytes):
+            i = rawdata.find(self.bstart)
+            j = rawdata.find(b'</div>', i)
+            if i < 0 or j < 0: return None
+            rawdata = rawdata[i:j + len('</div>')].decode('utf-8', 'replace')
+
+        i = rawdata.find(self.start)
+        if i < 0: return None
+
+        pars = []
+        out = []
+        stack = []
+        pos = i + len(self.start)
+
+        while True:
+            m = self.tokens.match(rawdata, pos)
+            if m is None: return None           # The div is never closed
+            pos = m.end()
+            kind = m.lastgroup
+
+            if kind == 'text':
+                out.append(m.group())
+                continue
+
+            if kind == 'sep':
+                self.paragraph(out, stack, pars)
+                out = []
+                continue
+
+            name = m.group('name')
+            if m.group('close'):
+                if name == 'div' and not m.group('attrs'): break
+                if name in self.names and stack and stack[-1][0] == name:
+                    out.append(stack.pop()[1])
+                else:
+                    out.append(m.group())
+                continue
+
+            key = (name, whitespace.sub(' ', m.group('attrs').strip()))
+            if key in self.reject: return None
+            if key in self.skip:
+                # The contents are raw text, like tex, which may contain a '<'
+                close = '</%s>' % name
+                pos = rawdata.find(close, pos)
+                if pos < 0: return None
+                pos = pos + len(close)
+            elif key in self.tags:
+                start, end = self.tags[key]
+                out.append(start)
+                stack.append((name, end))
+            elif name in self.names:
+                out.append(m.group())
+                stack.append((name, '</%s>' % name))
+            else:
+                out.append(m.group())
+
+        self.paragraph(out, stack, pars)
+        abstract = '\n'.join(pars)
+        if len(abstract) > 0: return abstract
+        return None
+
+
+    def paragraph(self, out, stack, pars):
+        """Closes the paragraph in out, appending it to pars unless it is empty"""
+        while stack: out.append(stack.pop()[1])
+        par = whitespace.sub(' ', ''.join(out)).strip()
+        if par: pars.append('<p>%s</p>' % par)
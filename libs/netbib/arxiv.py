@@ -33,6 +33,7 @@ import unicodedata
 
 from .utils import surname, strip_accents
 from .base import NetbibBase, NetbibError
+from .record import Record
 
 
 
@@ -54,41 +55,72 @@ class Arxiv(NetbibBase):
         self.sleep_time = 0.2
 
         self.arxiv_url = "http://export.arxiv.org/api/query"
-        self.ans = []
 
 
 
     # Internals
     # ------------------------------ #
 
-    def get_matches(self, params):
+    def get_matches(self, params, job):
         at = "{http://www.w3.org/2005/Atom}"
         query_url = '%s?%s' % (self.arxiv_url, urlencode(params))
-        raw = self.browser.open(query_url, timeout=self.timeout).read().strip()
-        rawdata = raw.decode('utf-8', errors='replace')
-        xmldata = xml.etree.ElementTree.fromstring(rawdata)
-        entries = xmldata.findall(at+"entry")
+        raw = self.fetch(query_url, job)
+
+        with job.stage('extract'):
+            entries = self.parse_feed(raw, job).findall(at+"entry")
 
         ans = []
         for result in entries:
-            d = {}
-            d['id'] = self.format_id(result.find(at+'id').text)
-            d['title'] = self.format_title(result.find(at+'title').text)
-            d['authors'] = [self.format_text(e.text) for e in result.findall(at+'author/'+at+'name')]
-            d['subject'] = [self.format_text(e.get('term')) for e in result.findall(at+'category')]
-            d['updated'] = self.format_text(result.find(at+'updated').text)
-            d['abstract'] = '<p>%s</p>' % self.format_text(result.find(at+'summary').text)
-            d['updated'] = self.format_text(result.find(at+'updated').text)
-            d['url'] = self.format_url(result.find(at+'link').get('href'))
+            with job.stage('normalize'):
+                d = self.entry_from_xml(result)
 
+            job.provide(d)
             ans.append(d)
 
         return ans
 
 
-    def get_item(self, bibid):
+    def parse_feed(self, raw, job):
+        """Parses the raw response as xml. The parser reads the bytes as they are, and
+           only a feed that is not valid utf-8 is decoded first, replacing errors."""
+        if raw[:1].isspace(): raw = raw.lstrip()
+        try:
+            return xml.etree.ElementTree.fromstring(raw)
+        except xml.etree.ElementTree.ParseError:
+            rawdata = self.decode(raw, job).strip().encode('utf-8')
+            if rawdata == raw: raise
+            return xml.etree.ElementTree.fromstring(rawdata)
+
+
+    def entry_from_xml(self, result):
+        """Extract information from an atom entry"""
+        at = "{http://www.w3.org/2005/Atom}"
+        ax = "{http://arxiv.org/schemas/atom}"
+
+        d = Record()
+        d['id'] = self.format_id(result.find(at+'id').text)
+        d['title'] = self.format_title(result.find(at+'title').text)
+        d['authors'] = [self.format_text(e.text) for e in result.findall(at+'author/'+at+'name')]
+        d['subject'] = [self.format_text(e.get('term')) for e in result.findall(at+'category')]
+        d['updated'] = self.format_text(result.find(at+'updated').text)
+        d['abstract'] = '<p>%s</p>' % self.format_text(result.find(at+'summary').text)
+        d['updated'] = self.format_text(result.find(at+'updated').text)
+        d['url'] = self.format_url(result.find(at+'link').get('href'))
+
+        doi = result.find(ax+'doi')
+        if doi is not None and doi.text:
+            d['doi'] = self.format_doi(doi.text)
+
+        return d
+
+
+    def get_item(self, bibid, job):
+        return self.shared(('arxiv-item', bibid), job, self.fetch_item, bibid, job)
+
+
+    def fetch_item(self, bibid, job):
         params = self.format_query({'id': bibid})
-        ans = self.get_matches(params)
+        ans = self.get_matches(params, job)
 
         if len(ans) > 0:
             return ans[0]
@@ -96,8 +128,8 @@ class Arxiv(NetbibBase):
         return None
 
 
-    def get_abstract(self, bibid):
-        ans = self.get_item(bibid)
+    def get_abstract(self, bibid, job):
+        ans = self.get_item(bibid, job)
 
         if 'abstract' in ans:
             return ans['abstract']
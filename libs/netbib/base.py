@@ -20,25 +20,55 @@
 from __future__ import (unicode_literals, division)
 
 import re
+import sys
 import threading
 import time
+
+if sys.version_info[0] >= 3:
+    from urllib.parse import urlparse
+else:
+    from urlparse import urlparse
+
 from .utils import metadata_distance, strip_accents
+from .bibtexparser import parse_bibtex
 from .latex_encoding import latex_decode
+from .jobs import Job, QueryJob, query_pool, fetch_pool
+from .transport import read_response, abortable, canonical_url, flights
+from .errors import NetbibError, NetbibCancelled, NetbibDeadline, NetbibUnavailable
+from .resilience import RetryPolicy, breakers
+from .xref import get_map
+from .record import Record, Lazy
+from . import stats
+from .metrics import registry
 
 
 
-class NetbibError(Exception):
-    def __init__(self, value):
-        self.value = value
+class NetbibBase(object):
+    def __init__(self):
+        # Abstract enrichment of search results
+        self.enrich_count = 5
+        self.enrich_workers = 3
+        self.enrich_timeout = 10
 
-    def __str__(self):
-        return repr(self.value)
+        # Seconds a request may spend connecting, within the time left to the job
+        self.connect_timeout = 10
 
+        self.retry = RetryPolicy()
+        self.breakers = breakers
+        self.flights = flights
 
+        # Optional RateLimiter for the requests, and ResponseCache for their bodies
+        self.limiter = None
+        self.cache = None
+        self.xref = get_map()
+        self.stats_hooks = []
 
-class NetbibBase(threading.Thread):
-    def __init__(self):
-        super(NetbibBase, self).__init__()
+        # Largest metadata_distance to the query of a paper found through the xref map
+        self.xref_distance = 0.3
+
+        self.pool = query_pool
+        self.fetch_pool = fetch_pool
+        self.local = threading.local()
 
         self.lang_map = {
             'english': 'eng',
@@ -53,64 +83,229 @@ class NetbibBase(threading.Thread):
     # Public interface
     # ------------------------------ #
 
-    def query(self, d, maxresults=20):
-        """Performs a query with the data in the dictionary d. Starts the job and returns
-           When the job is finished, the answer is in self.ans"""
+    def query(self, d, maxresults=20, timeout=None, token=None, on_result=None,
+              deadline=None):
+        """Performs a query with the data in the dictionary d on the shared pool. Returns
+           a QueryJob. When the job is finished, the answer is in job.ans. Cancelling the
+           token stops the query and any network request in flight. If given, on_result
+           is called with each item as soon as it is parsed, before ranking. If the
+           deadline, a time.time() value, passes before the query is done, the answer
+           holds the best results found so far."""
+        if timeout is None: timeout = self.timeout
+        job = QueryJob(d, maxresults=maxresults, timeout=timeout, token=token,
+                       on_result=on_result, deadline=deadline)
+        job.stats.source = self.__class__.__name__.lower()
+        job.add_done_callback(self.report_stats)
+        return self.pool.submit(job, self.run_query, job)
+
+
+    def query_and_wait(self, d, maxresults=20, timeout=None, token=None, deadline=None):
+        """Performs a query and waits until the job is done. Returns the answer."""
+        return self.query(d, maxresults, timeout, token, deadline=deadline).result()
 
-        self.maxresults = maxresults
-        self.query = d
-        self.start()
 
 
-    def query_and_wait(self, d, maxresults=20):
-        """Performs a query and waits until the job is done. Returns the answer."""
-        self.query(d, maxresults)
 
-        while self.is_alive():
-            self.join(0.2)
+    # Internals
+    # ------------------------------ #
 
-        return self.ans
+    def run_query(self, job):
+        """Performs the query in job and returns the sorted answer"""
+        try:
+            ans = self.get_answer(job)
+        except NetbibDeadline:
+            job.expired = True
+            ans = list(job.partial)
 
+        for item in job.partial:
+            self.remember_ids(item)
 
+        if len(ans) > 0:
+            with job.stage('rank'):
+                ans = self.sort_and_trim(ans, job)
+            job.stats.add('rank', results=len(ans))
 
+            if not job.expired:
+                with job.stage('enrich'):
+                    self.enrich(ans, job)
+
+        return ans
 
-    # Internals
-    # ------------------------------ #
 
-    def run(self):
-        """Runs the query thread"""
+    def get_answer(self, job):
+        """Collects the unsorted answer to the query in job. Tries the plans from
+           plan_query in turn, and records the one that succeeded in job.plan. A plan
+           that fails is recorded in the stats and the next one is tried. The error is
+           raised only if all plans failed."""
+        plans = self.plan_query(job.query)
+        errors = []
         ans = []
 
-        # check if querying by id
-        if 'id' in self.query:
-            item = self.get_item(self.query['id'])
-            if item:
-                # get abstract
-                if not 'abstract' in item:
-                    abstract = self.get_abstract(item['id'])
-                    if abstract:
-                        time.sleep(self.sleep_time)
-                        item['abstract'] = abstract
+        for i, (plan, query) in enumerate(plans):
+            if i > 0: self.pause(job)
 
-                ans.append(item)
+            job.stats.plan = plan
+            try:
+                with job.stage(plan):
+                    if plan == 'id':
+                        ans = self.get_by_id(query['id'], job)
+                    elif plan == 'xref':
+                        ans = self.get_by_id(query['id'], job, match=job.query)
+                    else:
+                        params = self.format_query(query, lax=(plan == 'lax'))
+                        ans = self.get_matches(params, job)
 
-        else:
-            # First run with authors as authors.
-            params = self.format_query(self.query, lax=False)
-            ans = self.get_matches(params)
+            except (NetbibCancelled, NetbibDeadline):
+                raise
 
-            # If no luck, try searching for the title words anywhere
-            if len(ans) == 0:
-                time.sleep(self.sleep_time)
-                params = self.format_query(self.query, lax=True)
-                ans = self.get_matches(params)
+            except Exception as e:
+                job.stats.fail(plan, e)
+                errors.append(e)
+                continue
 
-            # TODO: do more attempts?
+            job.stats.add(plan, results=len(ans))
+            if len(ans) > 0:
+                job.plan = plan
+                if plan == 'xref':
+                    registry.inc('cache_hits', source=job.stats.source, kind='xref')
+                break
 
-        if len(ans) > 0:
-            ans = self.sort_and_trim(ans)
+        if len(plans) > 0 and len(errors) == len(plans):
+            raise errors[-1]
+
+        return ans
+
+
+    def plan_query(self, query):
+        """Returns the plans to try for a query, cheapest first, as a list of pairs with
+           the plan name and the query it uses. Keys the source does not understand are
+           dropped. Identifiers from other sources are looked up in the cross reference
+           map, which may give our own id or a doi."""
+        known = self.lookup_ids(query)
+        query = dict((k, v) for k, v in query.items() if k in self.search_fields and v)
+        plans = []
+
+        if 'id' in query:
+            plans.append(('id', {'id': query['id']}))
+        elif self.idkey in known:
+            plans.append(('xref', {'id': known[self.idkey]}))
+
+        if not 'doi' in query and 'doi' in known and 'doi' in self.search_fields:
+            query['doi'] = known['doi']
+
+        if 'doi' in query:
+            plans.append(('doi', {'doi': query['doi']}))
+
+        fields = dict((k, v) for k, v in query.items() if k in ['title', 'authors'])
+        if len(fields) > 0:
+            plans.append(('strict', fields))
+
+            # Searching for the title words anywhere only differs if there is a title
+            if 'title' in fields:
+                plans.append(('lax', fields))
+
+        return plans
+
+
+    def lookup_ids(self, query):
+        """Returns all the identifiers known for the paper in query, keyed by scheme"""
+        ids = dict((k, query[k]) for k in self.xref.schemes if query.get(k, None))
+        if query.get('id', None): ids[self.idkey] = query['id']
+        return self.xref.lookup(ids)
+
+
+    def remember_ids(self, item):
+        """Adds the identifiers of an item to the cross reference map"""
+        ids = dict((k, item[k]) for k in self.xref.schemes if item.get(k, None))
+        if item.get('id', None): ids[self.idkey] = item['id']
+        self.xref.add(ids)
+
+
+    def get_by_id(self, bibid, job, match=None):
+        """Returns a list with the item with the given id and its abstract, if found.
+           If match is given, the item is only taken if it is close to it."""
+        item = self.get_item(bibid, job)
+        if not item: return []
+        if match and not self.is_close(match, item): return []
+
+        job.provide(item)
+
+        # get abstract
+        if not 'abstract' in item:
+            self.pause(job)
+            abstract = self.get_abstract(item['id'], job)
+            if abstract:
+                item['abstract'] = abstract
+
+        return [item]
+
+
+    def is_close(self, query, item):
+        """Whether item is within xref_distance of the title and authors in query.
+           Queries with neither are taken to match."""
+        fields = dict((k, query[k]) for k in ['title', 'authors'] if query.get(k, None))
+        if len(fields) == 0: return True
+        return metadata_distance(fields, item) <= self.xref_distance
+
+
+    def report_stats(self, job):
+        """Completes the stats of a finished job and passes them to the hooks"""
+        st = job.stats
+        st.elapsed = time.time() - st.started
+        st.plan = job.plan
+        st.retries = job.retries
+        st.expired = job.expired
+        st.cancelled = job.is_cancelled()
+        if job.error: st.error = repr(job.error)
 
-        self.ans = ans
+        for fn in self.stats_hooks + stats.hooks:
+            fn(st)
+
+
+    def enrich(self, ans, job):
+        """Fetches abstracts for the top ranked results concurrently on the fetch pool,
+           with at most enrich_workers requests at a time. Abstracts that arrive after
+           enrich_timeout seconds are skipped. Cancelling the job stops the wait."""
+
+        todo = [d for d in ans[:self.enrich_count] if 'id' in d and not 'abstract' in d]
+        if len(todo) == 0: return
+
+        deadline = time.time() + self.enrich_timeout
+        if job.deadline is not None:
+            deadline = min(deadline, job.deadline)
+        lock = threading.Lock()
+        pending = list(todo)
+        abstracts = {}
+        state = {'closed': False}
+
+        def worker():
+            while True:
+                with lock:
+                    if state['closed'] or len(pending) == 0: return
+                    d = pending.pop(0)
+
+                try:
+                    abstract = self.get_abstract(d['id'], job)
+                except Exception:
+                    abstract = None
+                    if job.is_cancelled(): return
+
+                with lock:
+                    if abstract and not state['closed']:
+                        abstracts[d['id']] = abstract
+
+        workers = [self.fetch_pool.submit(Job(), worker)
+                   for i in range(0, min(self.enrich_workers, len(todo)))]
+
+        for w in workers:
+            w.wait(max(0, deadline - time.time()), abort=job.token.event)
+        self.check_cancelled(job)
+
+        with lock:
+            state['closed'] = True
+            for d in todo:
+                if d['id'] in abstracts:
+                    d['abstract'] = abstracts[d['id']]
 
 
     def format_query(self, query, lax=False):
@@ -118,17 +313,23 @@ class NetbibBase(threading.Thread):
         raise NotImplementedError
 
 
-    def get_matches(self, params):
+    def get_matches(self, params, job):
         """Returns the answer to a query"""
         raise NotImplementedError
 
 
-    def get_item(self, bibid):
+    def get_item(self, bibid, job):
         """Returns an item by id"""
         raise NotImplementedError
 
 
-    def get_abstract(self, bibid):
+    def fetch_item(self, bibid, job):
+        """Retrieves an item by id. Used by get_item, which shares the result with
+           concurrent requests for the same item."""
+        raise NotImplementedError
+
+
+    def get_abstract(self, bibid, job):
         """Returns the answer to a query"""
         raise NotImplementedError
 
@@ -137,33 +338,177 @@ class NetbibBase(threading.Thread):
     # Utility stuff
     # ------------------------------ #
 
+    def fetch(self, url, job, sink=None):
+        """Retrieves url and returns the raw response body. Concurrent requests for the
+           same url share a single fetch, and bodies are kept in the cache if any.
+
+           A sink, if given, gets the body as it arrives: sink.reset() at the start of
+           each attempt, sink.feed(data) for each chunk and sink.close() at the end. Such
+           requests are not shared, since the body is consumed while it downloads."""
+        key = canonical_url(url)
+        if self.cache is not None:
+            raw = self.cache.get(key)
+            if raw is not None:
+                registry.inc('cache_hits', source=job.stats.source, kind='response')
+                if sink:
+                    sink.reset()
+                    sink.feed(raw)
+                    sink.close()
+                return raw
+
+        if sink: raw = self.fetch_url(url, job, sink)
+        else:    raw = self.shared(key, job, self.fetch_url, url, job)
+        if self.cache is not None: self.cache.put(key, raw)
+        return raw
+
+
+    def shared(self, key, job, fn, *args):
+        """Returns fn(*args), sharing the work with identical concurrent calls, which are
+           identified by key. Dictionaries and records are copied, so that each caller
+           gets its own."""
+        ans, shared = self.flights.do(key, lambda: fn(*args), job.token, job.remaining())
+        if shared:
+            registry.inc('cache_hits', source=job.stats.source, kind='single_flight')
+            if isinstance(ans, (dict, Record)): ans = ans.copy()
+        return ans
+
+
+    def fetch_url(self, url, job, sink=None):
+        """Retrieves url and returns the raw response body, passing it to sink as in
+           fetch. Transient errors are retried with backoff. Raises NetbibCancelled if
+           the job is cancelled before or while reading, NetbibDeadline if the job has
+           no time left for the request, and NetbibUnavailable if the circuit breaker
+           for the host is open."""
+        breaker = self.breakers.get(urlparse(url).netloc)
+        attempt = 0
+
+        while True:
+            self.check_cancelled(job)
+            timeout = job.request_timeout()
+            if timeout <= 0:
+                raise NetbibDeadline("Query deadline exceeded")
+
+            # A cancelled trial records no outcome, so it is released on the way out
+            trial = breaker.check()
+            try:
+                if self.limiter:
+                    with job.stage('throttle'):
+                        self.pause(job, self.limiter.reserve())
+
+                start = time.time()
+                try:
+                    with job.stage('network'):
+                        if sink: sink.reset()
+                        with abortable(job.token, min(timeout, self.connect_timeout)):
+                            resp = self.get_browser().open(url, timeout=timeout)
+                        raw = read_response(resp, job.token, sink=sink, deadline=job.deadline)
+
+                except Exception as e:
+                    self.check_cancelled(job)
+                    if not self.retry.is_transient(e):
+                        breaker.record_success()
+                        raise
+
+                    breaker.record_failure()
+                    wait = self.retry.wait_time(attempt, e)
+                    remaining = job.remaining()
+                    if wait is None or (remaining is not None and wait >= remaining):
+                        raise
+
+                    attempt = attempt + 1
+                    job.retries = job.retries + 1
+                    job.token.sleep(wait)
+                    continue
+
+                self.check_cancelled(job)
+                if sink: sink.close()
+                breaker.record_success()
+                job.stats.add('network', bytes=len(raw), requests=1)
+                registry.observe('request_seconds', time.time() - start,
+                                 source=job.stats.source, plan=job.stats.plan)
+                return raw
+
+            finally:
+                if trial: breaker.release()
+
+
+    def decode(self, raw, job):
+        """Decodes a response body into a string"""
+        with job.stage('decode'):
+            return raw.decode('utf-8', 'replace')
+
+
+    def parse_bibtex(self, txt, job):
+        """Parses bibtex entries and normalizes them into items"""
+        with job.stage('bibtex'):
+            L = parse_bibtex(txt)
+
+        with job.stage('normalize'):
+            return [self.entry_from_bibtex(bib) for bib in L]
+
+
+    def check_cancelled(self, job):
+        """Raises NetbibCancelled if the job has been cancelled"""
+        if job.is_cancelled():
+            raise NetbibCancelled("Query cancelled")
+
+
+    def pause(self, job, seconds=None):
+        """Sleeps between requests, sleep_time seconds unless given, returning early if
+           the job is cancelled. Raises NetbibDeadline if the deadline passes meanwhile."""
+        if seconds is None: seconds = self.sleep_time
+        remaining = job.remaining()
+        if remaining is not None and remaining <= seconds:
+            job.token.sleep(remaining)
+            self.check_cancelled(job)
+            raise NetbibDeadline("Query deadline exceeded")
+
+        if seconds > 0: job.token.sleep(seconds)
+        self.check_cancelled(job)
+
+
+    def get_browser(self):
+        """Returns a browser for the current thread. Mechanize browsers are not thread
+           safe, so each thread gets its own clone when the browser supports it."""
+        if not hasattr(self.local, 'browser'):
+            clone = getattr(self.browser, 'clone_browser', None)
+            if clone: self.local.browser = clone()
+            else:     self.local.browser = self.browser
+        return self.local.browser
+
+
     def format_url(self, url):
         return url.strip()
 
 
     def format_text(self, tx):
         tx2 = re.sub("\s+", ' ', latex_decode(tx.strip()))
-        tx2 = re.sub("{(\w*?)}", "\g<1>", tx2, re.DOTALL)    # Removes silly {}
+        tx2 = re.sub("{(\w*?)}", "\g<1>", tx2, flags=re.DOTALL)    # Removes silly {}
         return tx2
 
 
     def format_title(self, ti):
         tx = self.format_text(ti)
-        tx = re.sub("\$(.*?)\$", '\g<1>', tx, re.DOTALL)     # Remove dollars
-        tx = re.sub("{([^{}]*?)}", "\g<1>", tx, re.DOTALL)   # Removes more {}
-        m = re.match("(.*)\.", tx)                           # Removes dot at the end.
+        tx = re.sub("\$(.*?)\$", '\g<1>', tx, flags=re.DOTALL)     # Remove dollars
+        tx = re.sub("{([^{}]*?)}", "\g<1>", tx, flags=re.DOTALL)   # Removes more {}
+        m = re.match("(.*)\.", tx)                                 # Removes dot at the end.
         if m: tx = m.group(1)
         return tx
 
 
     def format_author(self, au):
         au = self.format_text(au)
-        au = re.sub("{([^{}]*?)}", "\g<1>", au, re.DOTALL)   # Removes more {}
+        au = re.sub("{([^{}]*?)}", "\g<1>", au, flags=re.DOTALL)   # Removes more {}
         L = au.split(',')
         if len(L) != 2: return au
         else:           return L[1].strip() + " " + L[0].strip()
 
 
+    def format_authors(self, aus):
+        """Format a list of authors separated by 'and'"""
+        return [self.format_author(e) for e in aus.split(' and ')]
+
+
     def format_year(self, yr):
         m = re.search('(\d+)', yr)
         if m: return m.group(1)
@@ -177,16 +522,16 @@ class NetbibBase(threading.Thread):
     def format_journal(self, txt):
         """Strip stuff in parenthesis"""
         txt = self.format_text(txt)
-        txt = re.sub("{([^{}]*?)}", "\g<1>", txt, re.DOTALL)  # Removes more {}
-        txt = re.sub("\(.*$", "", txt, re.DOTALL)             # Kill after first parenthesis.
-        txt = re.sub("\.[^.]*$", "", txt, re.DOTALL)          # Kill after last dot.
+        txt = re.sub("{([^{}]*?)}", "\g<1>", txt, flags=re.DOTALL)  # Removes more {}
+        txt = re.sub("\(.*$", "", txt, flags=re.DOTALL)             # Kill after first parenthesis.
+        txt = re.sub("\.[^.]*$", "", txt, flags=re.DOTALL)          # Kill after last dot.
         return txt.strip()
 
 
     def format_publisher(self, txt):
         txt = self.format_text(txt)
-        txt = re.sub("{([^{}]*?)}", "\g<1>", txt, re.DOTALL)  # Removes more {}
-        txt = re.sub("(\(|,|\.).*$", "", txt, re.DOTALL)      # Kill after first comma or parenthesis.
+        txt = re.sub("{([^{}]*?)}", "\g<1>", txt, flags=re.DOTALL)  # Removes more {}
+        txt = re.sub("(\(|,|\.).*$", "", txt, flags=re.DOTALL)      # Kill after first comma or parenthesis.
         return txt.strip()
 
 
@@ -229,33 +574,33 @@ class NetbibBase(threading.Thread):
         return strip_accents(txt).strip()
 
 
-    def sort_and_trim(self, ans):
+    def sort_and_trim(self, ans, job):
         """Sort results according to relevance and trim to max results."""
 
         def sort_key(d):
-            return metadata_distance(d, self.query, self.idkey)
+            return metadata_distance(d, job.query, self.idkey)
 
         ans.sort(key = sort_key)
-        return ans[:self.maxresults]
+        return ans[:job.maxresults]
 
 
     def entry_from_bibtex(self, bib):
-        """Extract information from a bibtex entry"""
+        """Extract information from a bibtex entry. The fields that need latex decoding
+           are normalized on first access, since most entries are discarded by
+           sort_and_trim and ranking only reads titles and authors."""
 
-        d = {}
+        d = Record()
 
         if 'bibtextype' in bib.keys():
             d['type'] = self.format_type(bib['bibtextype'])
 
         if 'title' in bib.keys():
-            d['title'] = self.format_title(bib['title'])
+            d['title'] = Lazy(self.format_title, bib['title'])
 
         if 'author' in bib.keys():
-            d['authors'] = [self.format_author(e)
-                            for e in bib['author'].split(' and ')]
+            d['authors'] = Lazy(self.format_authors, bib['author'])
         elif 'editor' in bib.keys():
-            d['authors'] = [self.format_author(e)
-                            for e in bib['editor'].split(' and ')]
+            d['authors'] = Lazy(self.format_authors, bib['editor'])
 
         if 'language' in bib.keys():
             lang =  self.format_language(bib['language'])
@@ -268,17 +613,17 @@ class NetbibBase(threading.Thread):
             d['isbn'] = self.format_isbn(bib['isbn'])
 
         if 'publisher' in bib.keys():
-            d['publisher'] = self.format_publisher(bib['publisher'])
+            d['publisher'] = Lazy(self.format_publisher, bib['publisher'])
 
         if 'series' in bib.keys():
-            d['series'] = self.format_text(bib['series'])
+            d['series'] = Lazy(self.format_text, bib['series'])
             if 'volume' in bib.keys():
                 d['series_index'] = self.format_number(bib['volume'])
 
         if 'fjournal' in bib.keys():
-            d['journal'] = self.format_journal(bib['fjournal'])
+            d['journal'] = Lazy(self.format_journal, bib['fjournal'])
         elif 'journal' in bib.keys():
-            d['journal'] = self.format_journal(bib['journal'])
+            d['journal'] = Lazy(self.format_journal, bib['journal'])
 
         if 'volume' in bib.keys():
             d['volume'] = self.format_number(bib['volume'])
@@ -291,6 +636,6 @@ class NetbibBase(threading.Thread):
             if year: d['year'] = year
 
         if 'abstract' in bib.keys():
-            d['abstract'] = latex_decode(bib['abstract'].strip())
+            d['abstract'] = Lazy(latex_decode, bib['abstract'].strip())
 
         return d
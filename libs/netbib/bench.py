@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division, print_function)
+
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+if sys.version_info[0] >= 3:
+    from urllib.parse import urlencode, urlsplit, parse_qsl
+else:
+    from urllib import urlencode
+    from urlparse import urlsplit, parse_qsl
+
+from .arxiv import Arxiv
+from .mathscinet import Mathscinet, Matches
+from .zentralblatt import Zentralblatt
+from .bibtexparser import parse_bibtex
+from .latex_encoding import latex_decode, latex_encode
+from .utils import metadata_distance, strip_accents
+from .jobs import QueryJob
+from .replay import Cassette, ReplayBrowser, RecordingBrowser
+from .corpus import Corpus, msc_codes
+from .record import Record
+
+# Benchmarks of the cpu bound parts of netbib, run from recorded responses. By default
+# the responses come from a synthetic corpus; --cassette uses a recorded one instead,
+# like the one left by 'make record'. Run from the libs directory, so that the tags
+# module is found:
+#
+#   python -m netbib.bench --save-baseline bench.json
+#   python -m netbib.bench --baseline bench.json
+#
+# The second run exits with status 1 if some benchmark got slower, or allocates more
+# memory, than the baseline by more than the tolerance. --save-fixtures records the
+# small cassettes that netbib.test_offline replays, one per source.
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+
+def corpus_cassette(corpus):
+    """Builds a cassette with the responses of all sources to author queries over the
+       synthetic corpus"""
+    cassette = Cassette()
+    arxiv, msn, zb = Arxiv(None), Mathscinet(None), Zentralblatt(None)
+
+    # Only the surnames that are ascii once stripped, which urlencode takes on python 2
+    surnames = set(strip_accents(a.split()[-1]) for p in corpus.papers for a in p['authors'])
+    for name in sorted(n for n in surnames if all(ord(c) < 128 for c in n)):
+        hits = corpus.search(authors=[name])[:20]
+        query = {'authors': [name]}
+
+        url = '%s?%s' % (arxiv.arxiv_url, urlencode(arxiv.format_query(query)))
+        cassette.add(url, corpus.arxiv_feed(hits).encode('utf-8'))
+
+        url = '%s?%s' % (msn.url, urlencode(msn.format_query(query)))
+        cassette.add(url, corpus.mathscinet_page(hits).encode('utf-8'))
+
+        url = '%s?%s' % (zb.url_query, urlencode(zb.format_query(query)))
+        cassette.add(url, corpus.zbmath_page(hits).encode('utf-8'))
+
+    for p in corpus.papers:
+        url = '%s/%s.bib' % (zb.url_bibtex, p['zbl'])
+        cassette.add(url, corpus.zbmath_bibtex(p).encode('utf-8'))
+
+        url = '%s?%s' % (zb.url_query, urlencode(zb.format_query({'id': p['zbl']})))
+        cassette.add(url, corpus.zbmath_document(p).encode('utf-8'))
+
+        url = '%s?pg1=MR&s1=%s' % (msn.url_abstract, p['mr'])
+        cassette.add(url, corpus.mathscinet_review(p).encode('utf-8'))
+
+    return cassette
+
+
+def record_fixtures(directory, size=3, seed=0):
+    """Records a small cassette per source, with the responses it needs to search the
+       synthetic corpus for an author and to look up the item and abstract of the first
+       hit. Returns the author."""
+    corpus = Corpus(size, seed)
+    cassette = corpus_cassette(corpus)
+
+    # Lookups by id, which corpus_cassette leaves out
+    arxiv, msn = Arxiv(None), Mathscinet(None)
+    for p in corpus.papers:
+        url = '%s?%s' % (arxiv.arxiv_url, urlencode(arxiv.format_query({'id': p['arxiv'] + 'v1'})))
+        cassette.add(url, corpus.arxiv_feed([p]).encode('utf-8'))
+
+        url = '%s?%s' % (msn.url, urlencode(msn.format_query({'id': p['mr']})))
+        cassette.add(url, corpus.mathscinet_page([p]).encode('utf-8'))
+
+    name = strip_accents(corpus.papers[0]['authors'][0].split()[-1])
+    for kind, cls in [('arxiv', Arxiv), ('mathscinet', Mathscinet), ('zbmath', Zentralblatt)]:
+        path = os.path.join(directory, '%s.json' % kind)
+        source = cls(RecordingBrowser(ReplayBrowser(cassette), Cassette(path)))
+        ans = source.get_matches(source.format_query({'authors': [name]}), QueryJob({}))
+        source.get_item(ans[0]['id'], QueryJob({}))
+        source.get_abstract(ans[0]['id'], QueryJob({}))
+
+        # Urls fetched twice only need their response once
+        recorded = Cassette.load(path)
+        for L in recorded.interactions.values(): del L[1:]
+        recorded.save()
+
+    return name
+
+
+def legacy_review(rawdata):
+    """Extracts a mathscinet review with the chain of regular expressions used before
+       abstract.Converter. The reference for the abstract benchmarks."""
+    m = re.search('<div class="review">(.*?)</div>', rawdata, re.DOTALL)
+    if not m: return None
+
+    L = re.findall("(.*?)<br\s*/>\s*&nbsp;\s*&nbsp;", m.group(1).strip() + '<br />&nbsp;&nbsp;',
+                   re.DOTALL)
+    Lpar = []
+    for par in L:
+        par = re.sub('\s+', ' ', par.strip())
+        par = re.sub('<span\s+class="it">(.*?)</span>', '<i>\g<1></i>', par, flags=re.DOTALL)
+        par = re.sub('<span\s+class="bf">(.*?)</span>', '<b>\g<1></b>', par, flags=re.DOTALL)
+        par = re.sub('<span\s+class="MathTeX">(.*?)</span>', '\g<1>', par, flags=re.DOTALL)
+        par = re.sub('<script\s+type="math/tex">(.*?)</script>', '', par, flags=re.DOTALL)
+        if par.strip(): Lpar.append('<p>%s</p>' % par.strip())
+    return '\n'.join(Lpar) or None
+
+
+def legacy_abstract(rawdata):
+    """Extracts a zbmath abstract with the regular expressions used before
+       abstract.Converter"""
+    m = re.search('<div class="abstract">(.*?)</div>', rawdata, re.DOTALL)
+    if not m or '<div class="scan">' in m.group(1): return None
+
+    L = re.findall("(.*?)\n\s*?\n", m.group(1).strip() + "\n\n", re.DOTALL)
+    Lpar = ['<p>%s</p>' % re.sub('\s+', ' ', par).strip() for par in L if par.strip()]
+    return '\n'.join(Lpar) or None
+
+
+def legacy_msc_tags(table, subj):
+    """The lookup of tags.msc_tags before the tables were compiled"""
+    ans = set()
+    m = re.match('([0-9]+)([A-Z]+)([0-9]+)', subj)
+    if m:
+        level1 = '%02d'   % int(m.group(1))
+        level2 = '%s%s'   % (level1, m.group(2))
+        level3 = '%s%02d' % (level2, int(m.group(3)))
+
+        ans.update(table.get(level1, []))
+        ans.update(table.get(level2, []))
+        ans.update(table.get(level3, []))
+    return ans
+
+
+def legacy_subject_tags(tags, subjects):
+    """The tags of a result as data2mi collected them before the tables were compiled"""
+    ans = set()
+    for s in subjects:
+        ans.update(legacy_msc_tags(tags._msc_tags, s))
+        ans.update(tags._arxiv_tags.get(s, []))
+    return ans
+
+
+def lengthen(page, start, sep, times=10):
+    """Returns page with the contents of the div opened by start repeated times times,
+       separated by sep"""
+    i = page.find(start) + len(start)
+    j = page.find('</div>', i)
+    return page[:i] + sep.join([page[i:j]] * times) + page[j:]
+
+
+def classify(url):
+    """Returns the kind of response at url"""
+    parts = urlsplit(url)
+    if parts.netloc.endswith('arxiv.org'):
+        return 'arxiv'
+    if parts.netloc.endswith('ams.org') and parts.path.endswith('publications.html'):
+        return 'mathscinet'
+    if parts.netloc.endswith('ams.org') and parts.path.endswith('publdoc.html'):
+        return 'publdoc'
+    if parts.netloc.endswith('zbmath.org') and parts.path.endswith('.bib'):
+        return 'zbmath-bibtex'
+    if parts.netloc.endswith('zbmath.org') and 'q=an' in parts.query:
+        return 'zbmath-document'
+    if parts.netloc.endswith('zbmath.org'):
+        return 'zbmath'
+    return None
+
+
+
+class Suite(object):
+    """The set of benchmarks, with their inputs taken from a cassette"""
+
+    def __init__(self, cassette, bibtex=None):
+        self.cassette = cassette
+        browser = ReplayBrowser(cassette)
+        self.arxiv = Arxiv(browser)
+        self.msn = Mathscinet(browser)
+        self.zb = Zentralblatt(browser)
+
+        self.urls = {}
+        for url, L in sorted(cassette.interactions.items()):
+            if L[-1]['status'] != 200: continue
+            self.urls.setdefault(classify(url), []).append(url)
+
+        self.bibtex = []
+        for url in self.urls.get('zbmath-bibtex', []):
+            self.bibtex.append(self.body(url))
+        for url in self.urls.get('mathscinet', []):
+            self.bibtex.extend(re.findall('<pre>(.*?)</pre>', self.body(url), re.DOTALL))
+
+        self.large = bibtex or '\n\n'.join(self.bibtex)
+        entries = parse_bibtex('\n\n'.join(self.bibtex))
+        self.batches = [entries[i:i+20] for i in range(0, len(entries), 20)]
+        self.ranking = []
+        self.searches = []
+        for params in self.params('mathscinet'):
+            ans = self.msn.get_matches(params, QueryJob({}))
+            if len(ans) > 0:
+                self.ranking.append((ans[0], ans))
+                query = dict((k, ans[0][k]) for k in ['title', 'authors'] if k in ans[0])
+                self.searches.append((query, params))
+
+        self.msc = []
+        for query, ans in self.ranking:
+            for d in ans: self.msc.extend(d.get('subject', []))
+
+        self.items = [d for query, ans in self.ranking for d in ans]
+        for params in self.params('arxiv'):
+            try:
+                self.items.extend(self.arxiv.get_matches(params, QueryJob({})))
+            except Exception:
+                pass
+
+
+    def body(self, url):
+        it = self.cassette.get(url)
+        return self.cassette.body(it).decode('utf-8', 'replace')
+
+
+    def params(self, kind):
+        return [dict(parse_qsl(urlsplit(url).query, keep_blank_values=True))
+                for url in self.urls.get(kind, [])]
+
+
+    def search(self, source, query, params, maxresults=5):
+        """A search as the plugin does it: find the matches, rank them and read all the
+           fields of the ones that are kept"""
+        job = QueryJob(query, maxresults=maxresults)
+        ans = source.sort_and_trim(source.get_matches(params, job), job)
+        return [dict(d.items()) for d in ans]
+
+
+    def normalize(self, batch):
+        """Normalizes the title, authors, journal and publisher of a batch of bibtex
+           entries with the format_* helpers of mathscinet"""
+        fields = [('title', self.msn.format_title), ('author', self.msn.format_authors),
+                  ('journal', self.msn.format_journal), ('publisher', self.msn.format_publisher)]
+        return [dict((f, fn(bib[f])) for f, fn in fields if f in bib) for bib in batch]
+
+
+    def benchmarks(self):
+        """Returns a list of (name, fn, inputs)"""
+        L = []
+        L.append(('arxiv.get_matches', lambda params: self.arxiv.get_matches(params, QueryJob({})),
+                  self.params('arxiv')))
+        L.append(('mathscinet.get_matches', lambda params: self.msn.get_matches(params, QueryJob({})),
+                  self.params('mathscinet')))
+        L.append(('zentralblatt.parse_bibtex', lambda txt: self.zb.parse_bibtex(txt, QueryJob({})),
+                  [self.body(url) for url in self.urls.get('zbmath-bibtex', [])]))
+        L.append(('mathscinet.extract_abstract', self.msn.extract_abstract,
+                  [self.body(url) for url in self.urls.get('publdoc', [])]))
+        L.append(('zentralblatt.extract_abstract', self.zb.extract_abstract,
+                  [self.body(url) for url in self.urls.get('zbmath-document', [])]))
+        L.append(('normalize', self.normalize, self.batches))
+        reviews = [lengthen(self.body(url), '<div class="review">', '<br />&nbsp;&nbsp;')
+                   for url in self.urls.get('publdoc', [])]
+        L.append(('abstract.mathscinet', self.msn.extract_abstract, reviews))
+        L.append(('abstract.mathscinet.legacy', legacy_review, reviews))
+        abstracts = [lengthen(self.body(url), '<div class="abstract">', '\n\n')
+                     for url in self.urls.get('zbmath-document', [])]
+        L.append(('abstract.zentralblatt', self.zb.extract_abstract, abstracts))
+        L.append(('abstract.zentralblatt.legacy', legacy_abstract, abstracts))
+        L.append(('latex_decode', latex_decode, self.bibtex))
+        L.append(('latex_encode', latex_encode, [latex_decode(txt) for txt in self.bibtex]))
+        L.append(('parse_bibtex.large', parse_bibtex, [self.large] if self.large else []))
+        L.append(('metadata_distance', lambda qd: metadata_distance(qd[0], qd[1], 'mr'),
+                  [(query, d) for query, ans in self.ranking for d in ans]))
+        L.append(('sort_and_trim', lambda qa: self.msn.sort_and_trim(list(qa[1]), QueryJob(qa[0])),
+                  self.ranking))
+        L.append(('mathscinet.search', lambda qp: self.search(self.msn, qp[0], qp[1]),
+                  self.searches))
+
+        try:
+            import tags
+        except ImportError:
+            tags = None
+
+        if tags:
+            # Subjects of results, three codes each, in result lists of twenty
+            codes = msc_codes()
+            subjects = [codes[i:i+3] for i in range(0, len(codes), 3)]
+            results = [subjects[i:i+20] for i in range(0, len(subjects), 20)]
+
+            L.append(('msc_tags', tags.msc_tags, self.msc + codes))
+            L.append(('msc_tags.cold', lambda code: (tags._msc_cache.clear(), tags.msc_tags(code)),
+                      codes))
+            L.append(('msc_tags.legacy', lambda code: legacy_msc_tags(tags._msc_tags, code), codes))
+            L.append(('subject_tags', lambda L: [tags.subject_tags(s) for s in L], results))
+            L.append(('subject_tags.legacy', lambda L: [legacy_subject_tags(tags, s) for s in L],
+                      results))
+
+        return [(name, fn, inputs) for name, fn, inputs in L if len(inputs) > 0]
+
+
+    def responses(self):
+        """Returns a list of (name, fn, inputs) with the handling of each kind of raw
+           response, from the bytes read to the results"""
+        def matches(raw):
+            sink = Matches(self.msn, QueryJob({}))
+            sink.reset()
+            sink.feed(raw)
+            sink.close()
+            return sink.ans
+
+        def raw(kind):
+            return [self.cassette.body(self.cassette.get(url)) for url in self.urls.get(kind, [])]
+
+        L = []
+        L.append(('response.arxiv', lambda raw: self.arxiv.parse_feed(raw, QueryJob({})),
+                  raw('arxiv')))
+        L.append(('response.mathscinet', matches, raw('mathscinet')))
+        L.append(('response.publdoc', self.msn.extract_abstract, raw('publdoc')))
+        L.append(('response.zbmath', self.zb.extract_bibids, raw('zbmath')))
+        L.append(('response.zbmath-document', self.zb.extract_abstract, raw('zbmath-document')))
+        return [(name, fn, inputs) for name, fn, inputs in L if len(inputs) > 0]
+
+
+    def representations(self):
+        """Returns a list of (name, fn) with the ways to represent results, where fn
+           copies an item into each representation"""
+        def as_dict(d):
+            ans = dict(d.items())
+            if 'authors' in ans: ans['authors'] = list(ans['authors'])
+            return ans
+
+        return [('dict', as_dict), ('record', Record)]
+
+
+
+def measure(fn, inputs, min_time=1.0, rounds=5):
+    """Runs fn over all inputs repeatedly for at least min_time seconds, split in a
+       number of rounds. Returns the calls per second of the best round, and the mean
+       peak of traced memory per call, in bytes. The latter is None when tracemalloc
+       is not available."""
+    for x in inputs: fn(x)
+
+    best = 0
+    for r in range(rounds):
+        count = 0
+        start = timer()
+        while True:
+            for x in inputs: fn(x)
+            count = count + len(inputs)
+            elapsed = timer() - start
+            if elapsed >= min_time / rounds: break
+        best = max(best, count / elapsed)
+
+    peak = None
+    if tracemalloc:
+        total = 0
+        tracemalloc.start()
+        for x in inputs:
+            tracemalloc.clear_traces()
+            base = tracemalloc.get_traced_memory()[0]
+            fn(x)
+            total = total + tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        peak = total / len(inputs)
+
+    return best, peak
+
+
+def measure_memory(fn, items, copies=20):
+    """Returns the mean traced memory, in bytes, held by fn(item) over copies copies of
+       each item. None when tracemalloc is not available."""
+    if not tracemalloc or len(items) == 0: return None
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    held = [fn(d) for i in range(copies) for d in items]
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    return size / len(held)
+
+
+def compare(results, baseline, tolerance):
+    """Returns the list of benchmarks that regressed with respect to the baseline"""
+    regressions = []
+    for name, r in sorted(results.items()):
+        b = baseline.get(name, None)
+        if b is None: continue
+
+        if r.get('bytes', None) is not None and b.get('bytes', None) is not None:
+            if r['bytes'] > b['bytes'] * (1 + tolerance):
+                regressions.append('%s: %.0f bytes/item, baseline %.0f' %
+                                   (name, r['bytes'], b['bytes']))
+            continue
+
+        if r['ops'] < b['ops'] * (1 - tolerance):
+            regressions.append('%s: %.1f ops/s, baseline %.1f' % (name, r['ops'], b['ops']))
+
+        if r['peak'] is not None and b.get('peak', None) is not None and \
+           r['peak'] > b['peak'] * (1 + tolerance):
+            regressions.append('%s: %.1f KiB peak, baseline %.1f' %
+                               (name, r['peak'] / 1024, b['peak'] / 1024))
+    return regressions
+
+
+def format_row(name, ops, peak, base):
+    txt = '%-30s %12.1f' % (name, ops)
+    txt = txt + ('%14.1f' % (peak / 1024) if peak is not None else '%14s' % '-')
+    if base:
+        txt = txt + '%+10.1f%%' % (100 * (ops / base['ops'] - 1))
+    return txt
+
+
+def run(suite, min_time=1.0, only=None, baseline=None):
+    results = {}
+    print('%-30s %12s %14s' % ('benchmark', 'ops/s', 'peak KiB/op') +
+          ('%11s' % 'vs base' if baseline else ''))
+
+    for name, fn, inputs in suite.benchmarks():
+        if only and not any(o in name for o in only): continue
+
+        try:
+            ops, peak = measure(fn, inputs, min_time)
+        except Exception as e:
+            results[name] = {'ops': 0, 'peak': None, 'inputs': len(inputs), 'error': type(e).__name__}
+            print('%-30s failed: %s' % (name, type(e).__name__))
+            continue
+
+        results[name] = {'ops': ops, 'peak': peak, 'inputs': len(inputs)}
+        print(format_row(name, ops, peak, (baseline or {}).get(name, None)))
+        sys.stdout.flush()
+
+    # Peak memory of the handling of a response, in copies of the response
+    responses = [r for r in suite.responses() if not only or any(o in r[0] for o in only)]
+    if tracemalloc and responses:
+        print('')
+        print('%-30s %12s %14s' % ('response', 'ops/s', 'copies'))
+        for name, fn, inputs in responses:
+            ops, peak = measure(fn, inputs, min_time)
+            copies = peak * len(inputs) / sum(len(raw) for raw in inputs)
+            results[name] = {'ops': ops, 'peak': peak, 'copies': copies, 'inputs': len(inputs)}
+            print('%-30s %12.1f %14.2f' % (name, ops, copies))
+
+    if tracemalloc and suite.items and (not only or any(o in 'memory.record' for o in only)):
+        print('')
+        print('%-30s %12s' % ('memory', 'bytes/item'))
+        for name, fn in suite.representations():
+            size = measure_memory(fn, suite.items)
+            results['memory.' + name] = {'bytes': size, 'inputs': len(suite.items)}
+            print('%-30s %12.0f' % ('memory.' + name, size))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m netbib.bench',
+                                     description='Benchmarks the parsers, decoders and ranking of netbib')
+    parser.add_argument('--cassette', help='recorded responses to run on, instead of the synthetic corpus')
+    parser.add_argument('--bibtex', help='large bibtex file for the parse_bibtex benchmark')
+    parser.add_argument('--size', type=int, default=200, help='papers in the synthetic corpus')
+    parser.add_argument('--time', type=float, default=1.0, help='seconds to run each benchmark')
+    parser.add_argument('--only', action='append', help='run only benchmarks containing this name')
+    parser.add_argument('--baseline', help='compare against the results stored in this file')
+    parser.add_argument('--save-baseline', help='store the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--save-fixtures', help='record the cassettes of the offline tests in this directory')
+    args = parser.parse_args(argv)
+
+    if args.save_fixtures:
+        print('Recorded a search for %s' % record_fixtures(args.save_fixtures))
+        return 0
+
+    if args.cassette: cassette = Cassette.load(args.cassette)
+    else:             cassette = corpus_cassette(Corpus(args.size))
+
+    bibtex = None
+    if args.bibtex:
+        with io.open(args.bibtex, 'r', encoding='utf-8', errors='replace') as fd:
+            bibtex = fd.read()
+
+    baseline = None
+    if args.baseline:
+        with io.open(args.baseline, 'r', encoding='utf-8') as fd:
+            baseline = json.load(fd)['results']
+
+    results = run(Suite(cassette, bibtex), args.time, args.only, baseline)
+
+    if args.save_baseline:
+        data = {'version': 1, 'python': sys.version.split()[0], 'results': results}
+        data = json.dumps(data, indent=2, sort_keys=True)
+        if isinstance(data, bytes): data = data.decode('utf-8')
+        with io.open(args.save_baseline, 'w', encoding='utf-8') as fd:
+            fd.write(data)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('')
+            print('Regressions beyond %d%%:' % (100 * args.tolerance))
+            for r in regressions: print('  ' + r)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
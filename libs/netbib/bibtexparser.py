@@ -29,24 +29,91 @@ def parse_bibtex(bibtex):
 
 def chop_bibtex(s):
     """Chops a bibtex string into individual entries."""
-    L = []
-    par = 0
-    opened = False
-    for i in range(0,len(s)):
-        if s[i] == '{':
-            par = par+1
-        elif s[i] == '}':
-            par = par-1
-            if par == 0 and opened:
-                b = i+1
-                opened = False
-                L.append(s[a:b])
-        elif s[i] == '@' and par == 0:
-            a = i
-            opened = True
-    return L
+    return Chopper().feed(s)
 
 
+_delimiters = re.compile('[{}@]')
+
+def iter_bibtex(fd, chunk_size=65536, text=False):
+    """Reads a bibtex file incrementally, yielding the same entries as chop_bibtex one at
+       a time, so that large files are never held in memory. With text=True, yields the
+       pieces of the file as pairs (kind, piece) like Chopper."""
+    chopper = Chopper(text)
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk: break
+
+        for e in chopper.feed(chunk):
+            yield e
+
+    for e in chopper.close():
+        yield e
+
+
+class Chopper(object):
+    """Chops bibtex that arrives in pieces into entries, like chop_bibtex. Only the
+       entry being read is kept. With text=True, the text between entries is returned
+       too, and the pieces are pairs (kind, piece) with kind 'entry' or 'text', which
+       put together give back the input."""
+
+    def __init__(self, text=False):
+        self.text = text
+        self.buf = ''
+        self.par = 0
+        self.start = None
+
+
+    def feed(self, chunk):
+        """Adds a piece of bibtex, returning the list of entries it completes"""
+        L = []
+        par = self.par
+        start = self.start
+        last = 0
+
+        pos = len(self.buf)
+        buf = self.buf + chunk
+        for m in _delimiters.finditer(buf, pos):
+            c = m.group(0)
+            if c == '{':
+                par = par+1
+            elif c == '}':
+                par = par-1
+                if par == 0 and start is not None:
+                    if not self.text:
+                        L.append(buf[start:m.end()])
+                    else:
+                        if start > last: L.append(('text', buf[last:start]))
+                        L.append(('entry', buf[start:m.end()]))
+                    last = m.end()
+                    start = None
+            elif par == 0:
+                start = m.start()
+
+        # Keep only the entry being read, and in text mode the text before it
+        if self.text:
+            self.buf = buf[last:]
+            if start is not None: start = start - last
+        elif start is None: self.buf = ''
+        else:
+            self.buf = buf[start:]
+            start = 0
+
+        self.par = par
+        self.start = start
+        return L
+
+
+    def close(self):
+        """Ends the input, returning the pieces left. In text mode, that is the text
+           after the last entry, with any entry that was never closed."""
+        buf = self.buf
+        self.buf = ''
+        self.par = 0
+        self.start = None
+
+        if self.text and buf: return [('text', buf)]
+        return []
+
 def parse_bibtex_entry(s):
     """Parses a bibtex entry producing a dictionary."""
     bib = {}
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division, print_function)
+
+import argparse
+import codecs
+import collections
+import io
+import os
+import re
+import sys
+import time
+
+from .arxiv import Arxiv
+from .mathscinet import Mathscinet
+from .zentralblatt import Zentralblatt
+from .bibtexparser import iter_bibtex, parse_bibtex_entry
+from .latex_encoding import latex_encode
+from .utils import metadata_distance
+from .jobs import Job, WorkerPool
+from .transport import ResponseCache, build_opener
+from .resilience import RateLimiter, RetryPolicy
+from .errors import NetbibDeadline, NetbibUnavailable
+from .journal import Journal, query_key
+from .replay import browser_from_env
+from .xref import get_map, normalize_doi
+from .server import point
+
+# Command line tool enriching bibtex files with the data found by netbib. Entries are
+# streamed from the input and written out in the same order as they are done, so that
+# large files are never held in memory. The rest of the file, comments and text between
+# entries included, is written out as it is. Only missing fields are added:
+#
+#   mathscinet     mrnumber, mrclass
+#   zentralblatt   zbl, msc2010
+#   arxiv          eprint, archiveprefix, primaryclass
+#   any of them    doi, abstract
+#
+# Run it as python -m netbib input.bib -o output.bib. With --journal, the outcome of
+# every entry is kept in a journal, so that an interrupted run can be restarted with the
+# same command: entries done are taken from the journal, and the failed ones retried.
+# The output is written to a temporary file, renamed when complete, so that it holds
+# every entry exactly once.
+
+sources = collections.OrderedDict([('mathscinet', Mathscinet),
+                                   ('zentralblatt', Zentralblatt),
+                                   ('arxiv', Arxiv)])
+
+
+
+class Enricher(object):
+    """Looks up bibtex entries on the netbib sources and adds the missing fields.
+       Answers found by the id of the entry, or carrying its doi, are taken as they are.
+       Answers to a search for the doi of the entry that do not carry it are dropped,
+       since the search may match it anywhere in a record. Other answers, including
+       those found through the cross reference map, are only taken if their
+       metadata_distance to the entry is at most max_distance. Sources that fail are retried following the
+       retry policy. If there is a journal, the outcome of each entry is recorded in
+       it, and entries already done are not looked up again."""
+
+    def __init__(self, workers, timeout=30, max_distance=0.3, abstracts=True, journal=None,
+                 retry=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_distance = max_distance
+        self.abstracts = abstracts
+        self.journal = journal
+        self.retry = retry or RetryPolicy(retries=0)
+
+
+    def entry_query(self, bib, src):
+        """Builds a query dictionary for src from a parsed bibtex entry"""
+        d = {}
+        if bib.get('title', None):
+            d['title'] = src.format_title(bib['title'])
+        if bib.get('author', None):
+            d['authors'] = [src.format_author(a) for a in bib['author'].split(' and ')]
+
+        ids = {}
+        if bib.get('mrnumber', None):
+            ids['mr'] = re.sub('^MR', '', bib['mrnumber'].strip().split()[0])
+        if bib.get('zbl', None):
+            ids['zbl'] = bib['zbl'].strip()
+        if bib.get('eprint', None) and bib.get('archiveprefix', 'arxiv').lower() == 'arxiv':
+            ids['arxiv'] = bib['eprint'].strip()
+        if bib.get('doi', None):
+            ids['doi'] = src.format_doi(bib['doi'])
+
+        d.update(ids)
+        if src.idkey in ids: d['id'] = ids[src.idkey]
+        return d
+
+
+    def enrich(self, raw):
+        """Returns the entry raw with the missing fields added, and the names of the
+           fields added"""
+        bib = parse_bibtex_entry(raw)
+        if bib is None or bib['bibtextype'].lower() in ['comment', 'string', 'preamble']:
+            return raw, []
+
+        found = self.resume(bib)
+
+        fields = collections.OrderedDict()
+        for name in self.workers.keys():
+            for k, v in found.get(name, []):
+                if v and not k in bib and not k in fields:
+                    fields[k] = v
+
+        if len(fields) == 0:
+            return raw, []
+
+        return self.add_fields(raw, fields), list(fields.keys())
+
+
+    def resume(self, bib):
+        """Looks up bib on the sources not done yet according to the journal, retrying
+           the ones that fail. Returns the fields found by each source, as lists of
+           pairs keyed by source name."""
+        names = list(self.workers.keys())
+        src = self.workers[names[0]]
+        query = dict((k, v) for k, v in self.entry_query(bib, src).items() if k != 'id')
+        key = query_key(query, sorted(names))
+
+        found = {}
+        todo = names
+        item = self.journal.get(key) if self.journal else None
+        if item:
+            found = item['result']['found']
+            if item['status'] == Journal.DONE: return found
+            todo = [n for n in item['result']['failed'] if n in self.workers]
+
+        attempt = 0
+        while True:
+            ans, errors = self.lookup(bib, todo)
+            found.update(ans)
+            todo = [n for n in todo if n in errors]
+            if len(todo) == 0: break
+
+            err = errors[todo[0]]
+            wait = self.retry.wait_time(attempt, err) if self.is_transient(err) else None
+            if wait is None: break
+
+            time.sleep(wait)
+            attempt = attempt + 1
+
+        if self.journal:
+            status = Journal.FAILED if len(todo) > 0 else Journal.DONE
+            error = '; '.join('%s: %s' % (n, errors[n]) for n in todo) if todo else None
+            self.journal.record(key, status, {'found': found, 'failed': todo}, error,
+                                attempts=attempt + 1)
+        return found
+
+
+    def lookup(self, bib, names):
+        """Queries the sources in names at once. Returns a dictionary with the fields
+           found by each source that answered, and one with the error of each source
+           that failed."""
+        deadline = time.time() + self.timeout
+        jobs = []
+        for name in names:
+            src = self.workers[name]
+            query = self.entry_query(bib, src)
+            if len(query) == 0: continue
+            jobs.append((name, query, src.query(query, maxresults=5, timeout=self.timeout,
+                                                deadline=deadline)))
+
+        found, errors = {}, {}
+        for name, query, job in jobs:
+            job.wait()
+            if job.error or job.expired:
+                errors[name] = job.error or NetbibDeadline("Query deadline exceeded")
+                continue
+
+            found[name] = []
+            if not job.ans: continue
+
+            d = job.ans[0]
+            if job.plan != 'id' and not self.has_doi(d, query.get('doi', None)):
+                if job.plan == 'doi' and query.get('doi', None): continue
+                if metadata_distance(query, d) > self.max_distance: continue
+
+            found[name] = self.fields(name, d)
+
+        return found, errors
+
+
+    def has_doi(self, d, doi):
+        """Whether the answer d carries the given doi"""
+        if not doi or not d.get('doi', None): return False
+        return normalize_doi(d['doi']) == normalize_doi(doi)
+
+
+    def is_transient(self, err):
+        return self.retry.is_transient(err) or isinstance(err, (NetbibUnavailable, NetbibDeadline))
+
+
+    def fields(self, name, d):
+        """Returns the bibtex fields for an answer of source name, as pairs"""
+        L = []
+        subject = d.get('subject', [])
+        if name == 'mathscinet':
+            L.append(('mrnumber', d.get('id', None)))
+            if subject:
+                L.append(('mrclass', subject[0] + (' (%s)' % ' '.join(subject[1:])
+                                                   if len(subject) > 1 else '')))
+        elif name == 'zentralblatt':
+            L.append(('zbl', d.get('id', None)))
+            if subject: L.append(('msc2010', ' '.join(subject)))
+        elif name == 'arxiv':
+            L.append(('eprint', re.sub('v\d+$', '', d.get('id', ''))))
+            L.append(('archiveprefix', 'arXiv'))
+            if subject: L.append(('primaryclass', subject[0]))
+
+        L.append(('doi', d.get('doi', None)))
+        if self.abstracts and d.get('abstract', None):
+            L.append(('abstract', html_to_text(d['abstract'])))
+        return [(k, v) for k, v in L if v]
+
+
+    def add_fields(self, raw, fields):
+        """Inserts fields before the closing brace of raw, keeping it otherwise as is"""
+        head = re.sub('[\s,]*}\s*$', '', raw)
+        m = re.search('\n([ \t]*)\S[^\n]*$', head)
+        indent = m.group(1) if m else '  '
+        lines = ['%s%s = {%s}' % (indent, k, latex_encode(v)) for k, v in fields.items()]
+        return head + ',\n' + ',\n'.join(lines) + '\n}'
+
+
+
+def html_to_text(html):
+    """Converts the html paragraphs of an abstract into plain text"""
+    pars = re.findall('<p>(.*?)</p>', html, re.DOTALL) or [html]
+    pars = [re.sub('<[^>]*>', '', p) for p in pars]
+    pars = [re.sub('\s+', ' ', p.replace('&amp;', '&').replace('&lt;', '<')
+                   .replace('&gt;', '>').replace('&nbsp;', ' ')).strip() for p in pars]
+    return '\n\n'.join(p for p in pars if len(p) > 0)
+
+
+def make_workers(names, browser, rate=None, cache_size=4096, xref=None, abstracts=True,
+                 server=None):
+    """Creates the sources, each with its own rate limiter, sharing a response cache"""
+    cache = ResponseCache(cache_size) if cache_size > 0 else None
+    workers = collections.OrderedDict()
+    for name in names:
+        src = sources[name](browser)
+        src.cache = cache
+        if rate: src.limiter = RateLimiter(rate)
+        if xref: src.xref = get_map(xref)
+        src.enrich_count = 1 if abstracts else 0
+        if server: point(src, server)
+        workers[name] = src
+    return workers
+
+
+def enrich_stream(pieces, enricher, concurrency=8, done=None):
+    """Enriches the entries in an iterable of pieces of bibtex, as given by iter_bibtex
+       with text=True, concurrency at a time. Yields the pieces in the same order, the
+       text between entries unchanged, keeping at most twice concurrency pieces in
+       memory. If given, done is called with the fields added to each entry."""
+    pool = WorkerPool(concurrency, 'netbib-cli')
+    window = collections.deque()
+
+    def finish(job):
+        if job.text: return job.raw
+
+        job.wait()
+        if job.error:
+            if done: done(None)
+            return job.raw
+
+        raw, fields = job.ans
+        if done: done(fields)
+        return raw
+
+    for kind, raw in pieces:
+        job = Job()
+        job.raw = raw
+        job.text = kind == 'text'
+        window.append(job if job.text else pool.submit(job, enricher.enrich, raw))
+        if len(window) >= 2 * concurrency:
+            yield finish(window.popleft())
+
+    while len(window) > 0:
+        yield finish(window.popleft())
+
+
+
+class Progress(object):
+    """Counts processed entries and reports them on stderr at most every interval
+       seconds"""
+
+    def __init__(self, interval=1, quiet=False):
+        self.interval = interval
+        self.quiet = quiet
+        self.start = time.time()
+        self.last = 0
+        self.entries = 0
+        self.enriched = 0
+        self.errors = 0
+        self.fields = collections.Counter()
+
+
+    def __call__(self, fields):
+        self.entries = self.entries + 1
+        if fields is None: self.errors = self.errors + 1
+        elif len(fields) > 0:
+            self.enriched = self.enriched + 1
+            self.fields.update(fields)
+
+        if time.time() - self.last >= self.interval:
+            self.report('\r')
+            self.last = time.time()
+
+
+    def report(self, end='\n'):
+        if self.quiet: return
+        elapsed = max(time.time() - self.start, 1e-6)
+        sys.stderr.write('%s%d entries, %d enriched, %d errors, %.1f entries/s' %
+                         (end, self.entries, self.enriched, self.errors,
+                          self.entries / elapsed))
+        sys.stderr.flush()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m netbib',
+                                     description='Fills in MR numbers, Zbl ids, arXiv ids, DOIs, '
+                                                 'abstracts and MSC classes in a bibtex file')
+    parser.add_argument('input', help="bibtex file to enrich, or - for stdin")
+    parser.add_argument('-o', '--output', default='-', help="where to write the result, stdout by default")
+    parser.add_argument('--sources', default=','.join(sources.keys()))
+    parser.add_argument('--concurrency', type=int, default=8, help='entries looked up at a time')
+    parser.add_argument('--rate', type=float, default=2, help='requests per second to each source')
+    parser.add_argument('--cache-size', type=int, default=4096, help='responses kept in memory')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds allowed for each entry')
+    parser.add_argument('--max-distance', type=float, default=0.3,
+                        help='how far from the entry an answer found by title and authors may be')
+    parser.add_argument('--no-abstracts', action='store_true', help="don't fetch abstracts")
+    parser.add_argument('--xref', help='keep the cross reference map of identifiers in this file')
+    parser.add_argument('--journal', help='record the entries done in this file, to resume an interrupted run')
+    parser.add_argument('--retries', type=int, default=3, help='times to retry a source that fails on an entry')
+    parser.add_argument('--server', help='base url of a stand-in server to use instead of the real sites')
+    parser.add_argument('--quiet', action='store_true', help="don't report progress")
+    args = parser.parse_args(argv)
+
+    workers = make_workers(args.sources.split(','), browser_from_env(build_opener()),
+                           args.rate, args.cache_size, args.xref, not args.no_abstracts,
+                           args.server)
+    journal = Journal(args.journal) if args.journal else None
+    retry = RetryPolicy(retries=args.retries, delay=2, max_delay=60)
+    enricher = Enricher(workers, args.timeout, args.max_distance, not args.no_abstracts,
+                        journal, retry)
+    progress = Progress(quiet=args.quiet)
+
+    if args.input == '-':
+        if sys.version_info[0] >= 3: fin = io.TextIOWrapper(sys.stdin.buffer, 'utf-8', 'replace')
+        else:                        fin = codecs.getreader('utf-8')(sys.stdin, 'replace')
+    else:
+        fin = io.open(args.input, 'r', encoding='utf-8', errors='replace')
+
+    if args.output == '-':
+        if sys.version_info[0] >= 3: fout = io.TextIOWrapper(sys.stdout.buffer, 'utf-8')
+        else:                        fout = codecs.getwriter('utf-8')(sys.stdout)
+    else:
+        fout = io.open(args.output + '.part', 'w', encoding='utf-8')
+
+    try:
+        pieces = iter_bibtex(fin, text=True)
+        for raw in enrich_stream(pieces, enricher, args.concurrency, progress):
+            fout.write(raw)
+    finally:
+        fout.flush()
+        if args.input != '-': fin.close()
+        if args.output != '-': fout.close()
+
+    if args.output != '-':
+        if os.path.exists(args.output): os.remove(args.output)
+        os.rename(args.output + '.part', args.output)
+
+    progress.report()
+    if not args.quiet:
+        cache = list(workers.values())[0].cache if len(workers) > 0 else None
+        sys.stderr.write('\n%s\n' % ', '.join('%s %d' % (k, v) for k, v in
+                                              sorted(progress.fields.items())))
+        if cache is not None:
+            sys.stderr.write('cache hits %d, misses %d\n' % (cache.stats()['hits'],
+                                                             cache.stats()['misses']))
+        if journal is not None:
+            sys.stderr.write('journal %s\n' % ', '.join('%s %d' % (k, v) for k, v in
+                                                        sorted(journal.counts().items())))
+    return 0
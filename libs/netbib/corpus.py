@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import random
+
+from .latex_encoding import latex_encode
+from .utils import strip_accents
+
+
+
+_words = ['moduli', 'spaces', 'of', 'stable', 'sheaves', 'on', 'surfaces', 'derived',
+          'categories', 'and', 'mirror', 'symmetry', 'homotopy', 'theory', 'for',
+          'algebraic', 'stacks', 'a', 'note', 'the', 'cohomology', 'motivic', 'integration',
+          'deformation', 'quantization', 'Poisson', 'manifolds', 'Hodge', 'structures',
+          'geometric', 'Langlands', 'correspondence', 'K-theory', 'operads', 'knots']
+
+_surnames = ['Kontsevich', 'Soibelman', 'Toën', 'Vaquié', 'Bökstedt', 'Madsen', 'Witten',
+             'Quillen', 'Serre', 'Grothendieck', 'Deligne', 'Müller', 'Łojasiewicz',
+             'Pérez', 'Gukov', 'Bott', 'Mathai', 'Simpson', 'Lurie', 'Étienne']
+
+_names = ['Maxim', 'Yan', 'Bertrand', 'Michel', 'Marcel', 'Ib', 'Edward', 'Daniel',
+          'Jean-Pierre', 'Alexander', 'Pierre', 'Anna', 'Stanisław', 'José', 'Sergei']
+
+_journals = ['Inventiones Mathematicae', 'Annals of Mathematics. Second Series',
+             'Publications Mathématiques. Institut de Hautes Études Scientifiques',
+             'Journal of the American Mathematical Society', 'Advances in Mathematics',
+             'Duke Mathematical Journal']
+
+_msc = ['14D20', '14D23', '14F05', '18E30', '53D37', '55P42', '19D10', '14A22',
+        '53D55', '14J32', '57M25', '81T30', '22E57', '11G25', '14C15']
+
+_arxiv = ['math.AG', 'math.AT', 'math.CT', 'math.SG', 'hep-th', 'math.QA', 'math.KT']
+
+# Top level classes of MSC2010
+_msc2010 = ['00', '01', '03', '05', '06', '08', '11', '12', '13', '14', '15', '16', '17',
+            '18', '19', '20', '22', '26', '28', '30', '31', '32', '33', '34', '35', '37',
+            '39', '40', '41', '42', '43', '44', '45', '46', '47', '49', '51', '52', '53',
+            '54', '55', '57', '58', '60', '62', '65', '68', '70', '74', '76', '78', '80',
+            '81', '82', '83', '85', '86', '90', '91', '92', '93', '94', '97']
+
+
+
+def msc_codes(size=5000, seed=0):
+    """Returns size MSC2010 codes, like those in the subjects of search results. Some
+       codes are far more frequent than others, as in real results."""
+    rnd = random.Random(seed)
+    codes = sorted(set('%s%s%02d' % (rnd.choice(_msc2010), rnd.choice('ABCDEFGHJKLMNPQRSTUXZ'),
+                                     rnd.choice([5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 99]))
+                       for i in range(size // 4)) | set(_msc))
+    return [codes[min(int(rnd.paretovariate(1)) - 1, len(codes) - 1)] if rnd.random() < 0.5
+            else rnd.choice(codes) for i in range(size)]
+
+
+
+class Corpus(object):
+    """Deterministic synthetic corpus of papers, with renderers producing the responses
+       of arxiv, mathscinet and zbmath for them. Used for benchmarks and the stand-in
+       servers when no recorded responses are available."""
+
+    def __init__(self, size=200, seed=0):
+        rnd = random.Random(seed)
+        self.papers = [self.make_paper(i, rnd) for i in range(size)]
+        self.by_id = {}
+        for p in self.papers:
+            for k in ['arxiv', 'mr', 'zbl', 'doi']:
+                self.by_id[(k, p[k])] = p
+
+
+    def make_paper(self, i, rnd):
+        nauthors = rnd.randint(1, 3)
+        authors = ['%s %s' % (rnd.choice(_names), rnd.choice(_surnames)) for k in range(nauthors)]
+        title = ' '.join(rnd.choice(_words) for k in range(rnd.randint(4, 12)))
+        title = title[0].upper() + title[1:]
+        review = [' '.join(rnd.choice(_words) for k in range(rnd.randint(40, 120)))
+                  for k in range(rnd.randint(1, 4))]
+
+        return {'mr': '%07d' % (2000000 + i),
+                'zbl': '%04d.%05d' % (1000 + i % 300, 10000 + i),
+                'arxiv': '%02d%02d.%05d' % (10 + i % 15, 1 + i % 12, i),
+                'doi': '10.%d/synthetic.%d' % (1000 + i % 50, i),
+                'title': title,
+                'authors': authors,
+                'journal': rnd.choice(_journals),
+                'year': '%d' % rnd.randint(1960, 2015),
+                'volume': '%d' % rnd.randint(1, 200),
+                'number': '%d' % rnd.randint(1, 12),
+                'pages': '%d--%d' % (i, i + rnd.randint(5, 50)),
+                'msc': rnd.sample(_msc, rnd.randint(1, 3)),
+                'categories': rnd.sample(_arxiv, rnd.randint(1, 2)),
+                'review': review}
+
+
+
+    # Lookup
+    # ------------------------------ #
+
+    def get(self, scheme, value):
+        return self.by_id.get((scheme, value), None)
+
+
+    def search(self, title=None, authors=None, lax=False):
+        """Returns the papers matching all title words and author surnames"""
+        def norm(s): return strip_accents(s).lower()
+
+        words = [norm(w) for w in (title or '').split() if len(w) > 0]
+        names = [norm(a.split()[-1]) for a in (authors or []) if len(a.strip()) > 0]
+
+        ans = []
+        for p in self.papers:
+            text = norm(p['title'])
+            if lax: text = text + ' ' + norm(' '.join(p['review']))
+            if not all(w in text for w in words): continue
+
+            surnames = [norm(a.split()[-1]) for a in p['authors']]
+            if not all(any(n in s for s in surnames) for n in names): continue
+
+            ans.append(p)
+        return ans
+
+
+
+    # Renderers
+    # ------------------------------ #
+
+    def bibtex_author(self, p):
+        return ' and '.join('%s, %s' % (latex_encode(a.split(' ', 1)[1], 'accents'),
+                                        latex_encode(a.split(' ', 1)[0], 'accents'))
+                            for a in p['authors'])
+
+
+    def mrclass(self, p):
+        if len(p['msc']) == 1: return p['msc'][0]
+        return '%s (%s)' % (p['msc'][0], ' '.join(p['msc'][1:]))
+
+
+    def mathscinet_bibtex(self, p):
+        return ('@article {MR%s,\n'
+                '    AUTHOR = {%s},\n'
+                '     TITLE = {%s},\n'
+                '   JOURNAL = {%s},\n'
+                '  FJOURNAL = {%s},\n'
+                '    VOLUME = {%s},\n'
+                '      YEAR = {%s},\n'
+                '    NUMBER = {%s},\n'
+                '     PAGES = {%s},\n'
+                '      ISSN = {0020-9910},\n'
+                '   MRCLASS = {%s},\n'
+                '  MRNUMBER = {%s},\n'
+                'MRREVIEWER = {Reviewer Name},\n'
+                '       DOI = {%s},\n'
+                '       URL = {http://dx.doi.org/%s},\n'
+                '}') % (p['mr'], self.bibtex_author(p), latex_encode(p['title'], 'accents'),
+                        latex_encode(p['journal'][:20] + '.', 'accents'),
+                        latex_encode(p['journal'], 'accents'), p['volume'], p['year'],
+                        p['number'], p['pages'], self.mrclass(p),
+                        p['mr'], p['doi'], p['doi'])
+
+
+    def zbmath_bibtex(self, p):
+        return ('@Article{zbMATH%s,\n'
+                '    Author = {%s},\n'
+                '    Title = {{%s}},\n'
+                '    FJournal = {{%s}},\n'
+                '    Journal = {{%s}},\n'
+                '    ISSN = {0020-9910},\n'
+                '    Volume = {%s},\n'
+                '    Number = {%s},\n'
+                '    Pages = {%s},\n'
+                '    Year = {%s},\n'
+                '    Publisher = {Springer, Berlin/Heidelberg},\n'
+                '    Language = {English},\n'
+                '    DOI = {%s},\n'
+                '    MSC2010 = {%s},\n'
+                '    Zbl = {%s}\n'
+                '}\n') % (p['zbl'].replace('.', ''), self.bibtex_author(p),
+                          latex_encode(p['title'], 'accents'),
+                          latex_encode(p['journal'], 'accents'),
+                          latex_encode(p['journal'][:20] + '.', 'accents'),
+                          p['volume'], p['number'], p['pages'], p['year'], p['doi'],
+                          ' '.join(p['msc']), p['zbl'])
+
+
+    def mathscinet_page(self, papers):
+        """Search results page of mathscinet with fmt=bibtex and extend=1"""
+        pres = ''.join('<pre>\n%s\n</pre>\n' % self.mathscinet_bibtex(p) for p in papers)
+        return ('<html><head><title>MathSciNet Search</title></head><body>\n'
+                '<div class="headlineMenu">Matches: %d</div>\n'
+                '<div class="doc">\n%s</div>\n'
+                '</body></html>\n') % (len(papers), pres)
+
+
+    def mathscinet_review(self, p):
+        """Publication page of mathscinet, with the review"""
+        pars = '<br />&nbsp;&nbsp;'.join(
+            '%s <span class="it">%s</span> <span class="MathTeX">$x^2$</span>'
+            '<script type="math/tex">x^2</script>' % (r, p['title']) for r in p['review'])
+        return ('<html><body>\n<div class="headline"><strong>MR%s</strong></div>\n'
+                '<div class="review">%s</div>\n</body></html>\n') % (p['mr'], pars)
+
+
+    def zbmath_page(self, papers):
+        """Search results page of zbmath"""
+        items = ''.join('<div class="item"><a class="title" href="?q=an:%s">%s</a>'
+                        '<a href="bibtex/%s.bib">BibTeX</a></div>\n'
+                        % (p['zbl'], p['title'], p['zbl']) for p in papers)
+        return '<html><body>\n<div class="list">\n%s</div>\n</body></html>\n' % items
+
+
+    def zbmath_document(self, p):
+        """Document page of zbmath, with the abstract or review"""
+        pars = '\n\n'.join(p['review'])
+        return ('<html><body>\n<div class="item">%s<a href="bibtex/%s.bib">BibTeX</a></div>\n'
+                '<div class="abstract">%s</div>\n</body></html>\n') % (p['title'], p['zbl'], pars)
+
+
+    def arxiv_entry(self, p):
+        authors = ''.join('<author><name>%s</name></author>' % a for a in p['authors'])
+        cats = ''.join('<category term="%s" scheme="http://arxiv.org/schemas/atom"/>' % c
+                       for c in p['categories'])
+        return ('<entry>\n<id>http://arxiv.org/abs/%sv1</id>\n'
+                '<updated>%s-01-01T00:00:00Z</updated>\n'
+                '<published>%s-01-01T00:00:00Z</published>\n'
+                '<title>%s</title>\n<summary>%s</summary>\n%s\n'
+                '<arxiv:doi xmlns:arxiv="http://arxiv.org/schemas/atom">%s</arxiv:doi>\n'
+                '<link href="http://arxiv.org/abs/%sv1" rel="alternate" type="text/html"/>\n'
+                '%s\n</entry>\n') % (p['arxiv'], p['year'], p['year'], p['title'],
+                                     ' '.join(p['review']), authors, p['doi'], p['arxiv'], cats)
+
+
+    def arxiv_feed(self, papers, start=0, total=None):
+        """Atom feed of the arxiv api"""
+        if total is None: total = len(papers)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+                '<title type="html">ArXiv Query</title>\n'
+                '<opensearch:totalResults xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">%d</opensearch:totalResults>\n'
+                '<opensearch:startIndex xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">%d</opensearch:startIndex>\n'
+                '%s</feed>\n') % (total, start, ''.join(self.arxiv_entry(p) for p in papers))
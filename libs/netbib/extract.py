@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import (unicode_literals, division)
+
+# Incremental extraction of the blocks of a page as the response arrives. The page is
+# fed in chunks of bytes, and each block is returned as soon as its closing tag is read,
+# so that it can be parsed while the rest of the page downloads. The tags are looked up
+# in the bytes, and only the contents of the blocks are decoded.
+#
+#   >>> blocks = Blocks('<div class="doc">', '<pre>', '</pre>', '</div>')
+#   >>> blocks.feed(b'<div class="doc"><pre>@article{a,')
+#   []
+#   >>> blocks.feed(b'}</pre><pre>')
+#   ['@article{a,}']
+
+
+
+class Blocks(object):
+    """Extracts the text between the tags opening and closing from a page read in
+       chunks. Only the part of the page after start and before end is considered,
+       like a non greedy regular expression would. The chunks are utf-8 bytes, where
+       undecodable bytes are replaced."""
+
+    def __init__(self, start, opening, closing, end=None):
+        self.start = start.encode('utf-8')
+        self.opening = opening.encode('utf-8')
+        self.closing = closing.encode('utf-8')
+        self.end = end.encode('utf-8') if end else None
+
+        self.buf = b''
+        self.started = False
+        self.finished = False
+
+
+    def feed(self, data):
+        """Adds a chunk of the page, returning the list of blocks it completes"""
+        if self.finished: return []
+        buf = self.buf + data
+        pos = 0
+
+        if not self.started:
+            i = buf.find(self.start)
+            if i < 0:
+                self.buf = buf[-len(self.start):]
+                return []
+            pos = i + len(self.start)
+            self.started = True
+
+        L = []
+        j = buf.find(self.end, pos) if self.end else -1
+        while True:
+            i = buf.find(self.opening, pos)
+            if j >= 0 and (i < 0 or j < i):
+                self.finished = True
+                return L
+
+            if i < 0:
+                # Keep what may be the beginning of a tag
+                keep = max(len(self.opening), len(self.end or b''))
+                self.buf = buf[max(pos, len(buf) - keep):]
+                return L
+
+            k = buf.find(self.closing, i + len(self.opening))
+            if j >= 0 and (k < 0 or k > j):
+                self.finished = True
+                return L
+
+            if k < 0:
+                self.buf = buf[i:]
+                return L
+
+            L.append(buf[i + len(self.opening):k].decode('utf-8', 'replace'))
+            pos = k + len(self.closing)
+
+
+    def close(self):
+        """Ends the page, dropping a block left open. Returns the blocks completed,
+           which is none since blocks end at their closing tag."""
+        self.buf = b''
+        return []
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import sys
+import threading
+import time
+import traceback
+
+from .stats import QueryStats
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+
+
+class Job(object):
+    """Handle to some work running on a WorkerPool, much like a future. When the work
+       is finished, the answer is in self.ans, or the exception in self.error."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.ans = None
+        self.error = None
+
+
+
+    # Public interface
+    # ------------------------------ #
+
+    def is_done(self):
+        return self.done.is_set()
+
+
+    def add_done_callback(self, fn):
+        """Registers fn to be called with the job as argument when it is done. If it is
+           already done, fn is called right away."""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+
+    def wait(self, timeout=None, abort=None):
+        """Blocks until the job is done, the abort event is set or timeout expires.
+           Returns True if the job is done."""
+        if abort is None:
+            self.done.wait(timeout)
+            return self.done.is_set()
+
+        wake = threading.Event()
+        self.add_done_callback(lambda job: wake.set())
+
+        key = abort_watcher.add(abort, wake)
+        try:
+            wake.wait(timeout)
+        finally:
+            abort_watcher.remove(key)
+        return self.done.is_set()
+
+
+    def result(self, timeout=None):
+        """Waits for the job and returns its answer, raising its error if it failed."""
+        self.wait(timeout)
+        if self.error: raise self.error
+        return self.ans
+
+
+
+    # Internals
+    # ------------------------------ #
+
+    def run(self, fn, *args):
+        """Runs fn(*args) and stores its outcome"""
+        try:
+            self.finish(ans=fn(*args))
+        except Exception as e:
+            self.finish(error=e)
+
+
+    def finish(self, ans=None, error=None):
+        """Marks the job as done and runs the callbacks. Only the first call counts."""
+        with self.lock:
+            if self.done.is_set(): return
+            if error is None: self.ans = ans
+            else:             self.error = error
+            self.done.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+
+
+
+class AbortWatcher(object):
+    """Wakes up the waiters of Job.wait when their abort event is set. A plain event
+       can not be waited on together with the job, so a single thread polls the abort
+       events of all current waiters every interval seconds, and exits when there are
+       none left."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+    def add(self, abort, wake):
+        """Watches abort, setting wake when it is set. Returns a key for remove."""
+        key = object()
+        with self.lock:
+            self.waiters[key] = (abort, wake)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='netbib-abort-watcher')
+                self.thread.daemon = True
+                self.thread.start()
+        return key
+
+
+    def remove(self, key):
+        with self.lock:
+            self.waiters.pop(key, None)
+
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.waiters:
+                    self.thread = None
+                    return
+                waiters = list(self.waiters.values())
+
+            for abort, wake in waiters:
+                if abort.is_set(): wake.set()
+            time.sleep(self.interval)
+
+
+abort_watcher = AbortWatcher()
+
+
+
+class CancelToken(object):
+    """Cooperative cancellation flag. Work checks it between steps, and registers
+       callbacks to abort blocking operations, like open network reads."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+
+    def cancel(self):
+        """Cancels the token and runs the callbacks. Only the first call counts."""
+        with self.lock:
+            if self.event.is_set(): return
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for fn in callbacks:
+            fn()
+
+
+    def add_callback(self, fn):
+        """Registers fn to be called when the token is cancelled. If it is already
+           cancelled, fn is called right away."""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn()
+
+
+    def remove_callback(self, fn):
+        with self.lock:
+            if fn in self.callbacks:
+                self.callbacks.remove(fn)
+
+
+    def sleep(self, seconds):
+        """Sleeps for the given time. Returns early, with True, if cancelled."""
+        return self.event.wait(seconds)
+
+
+
+class QueryJob(Job):
+    """A query to a netbib source. Holds all the per query state, so that sources can be
+       shared by concurrent queries. Cancelling the token finishes the job right away."""
+
+    def __init__(self, query, maxresults=20, timeout=30, token=None, on_result=None,
+                 deadline=None):
+        super(QueryJob, self).__init__()
+        self.query = query
+        self.maxresults = maxresults
+        self.timeout = timeout
+        self.ans = []
+
+        # End to end deadline, as a time.time() value
+        self.deadline = deadline
+        self.expired = False
+
+        # Instrumentation
+        self.stats = QueryStats()
+        self.retries = 0
+
+        # Name of the plan that found the answer
+        self.plan = None
+
+        # Provisional results, in the order they were parsed
+        self.partial = []
+        self.seen = set()
+        self.on_result = on_result
+
+        self.token = token or CancelToken()
+        self.token.add_callback(self.abandon)
+        self.add_done_callback(lambda job: self.token.remove_callback(self.abandon))
+
+
+    def abandon(self):
+        """Finishes the job with an empty answer, leaving the work behind"""
+        self.finish(ans=[])
+
+
+    def provide(self, item):
+        """Records a freshly parsed item as a provisional result and passes it on to the
+           on_result callback. Items already provided, by id, are ignored."""
+        key = item.get('id', id(item))
+        with self.lock:
+            if key in self.seen or self.token.is_cancelled(): return
+            self.seen.add(key)
+            self.partial.append(item)
+
+        if self.on_result:
+            self.on_result(item)
+
+
+    def remaining(self):
+        """Seconds left until the deadline, or None if there is no deadline"""
+        if self.deadline is None: return None
+        return max(0, self.deadline - time.time())
+
+
+    def request_timeout(self):
+        """Timeout for a single request, so that it does not overrun the deadline"""
+        remaining = self.remaining()
+        if remaining is None: return self.timeout
+        return min(self.timeout, remaining)
+
+
+    def stage(self, name):
+        """Accounts the time spent inside a with block to stage name in the stats"""
+        return self.stats.stage(name)
+
+
+    def cancel(self):
+        self.token.cancel()
+
+
+    def is_cancelled(self):
+        return self.token.is_cancelled()
+
+
+
+class WorkerPool(object):
+    """A fixed set of long lived threads running jobs from a shared queue. Threads are
+       started on demand, up to size."""
+
+    def __init__(self, size=4, name='netbib'):
+        self.size = size
+        self.name = name
+        self.tasks = queue.Queue()
+        self.threads = []
+        self.idle = 0
+        self.lock = threading.Lock()
+
+
+    def submit(self, job, fn, *args):
+        """Schedules fn(*args) to run on the pool. The outcome goes into job, which is
+           returned."""
+        with self.lock:
+            self.tasks.put((job, fn, args))
+            if self.idle == 0 and len(self.threads) < self.size:
+                t = threading.Thread(target=self.worker,
+                                     name='%s-%d' % (self.name, len(self.threads)))
+                t.daemon = True
+                self.threads.append(t)
+                t.start()
+            else:
+                self.idle = self.idle - 1
+        return job
+
+
+    def worker(self):
+        while True:
+            job, fn, args = self.tasks.get()
+            job.run(fn, *args)
+            with self.lock:
+                self.idle = self.idle + 1
+
+
+
+# Shared pools. Queries go to query_pool. Requests issued from within a query, like
+# abstract enrichment, go to fetch_pool so that they never wait behind their parent.
+query_pool = WorkerPool(size=8, name='netbib-query')
+fetch_pool = WorkerPool(size=8, name='netbib-fetch')
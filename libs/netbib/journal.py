@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from .utils import strip_accents, surname
+
+
+
+class Journal(object):
+    """Durable record of the items done by a batch job, so that a restarted job skips
+       them. Items are keyed by their normalized query, and each holds its status, done
+       or failed, the number of attempts, and a json serializable result. Kept in an
+       sqlite database at path, or in memory if path is None."""
+
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path=None):
+        self.path = path or ':memory:'
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        if self.path != ':memory:':
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS items ("
+                        "  key TEXT PRIMARY KEY,"
+                        "  status TEXT NOT NULL,"
+                        "  attempts INTEGER NOT NULL,"
+                        "  result TEXT,"
+                        "  error TEXT,"
+                        "  updated REAL NOT NULL)")
+        self.db.commit()
+
+
+
+    # Public interface
+    # ------------------------------ #
+
+    def get(self, key):
+        """Returns the item with key as a dictionary, or None if it was never tried"""
+        with self.lock:
+            row = self.db.execute("SELECT status, attempts, result, error, updated "
+                                  "FROM items WHERE key = ?", (key,)).fetchone()
+        if row is None: return None
+
+        return {'status': row[0],
+                'attempts': row[1],
+                'result': json.loads(row[2]) if row[2] is not None else None,
+                'error': row[3],
+                'updated': row[4]}
+
+
+    def record(self, key, status, result=None, error=None, attempts=1):
+        """Records the outcome of attempts more attempts at the item with key. The item
+           is on disk when this returns."""
+        data = json.dumps(result, sort_keys=True) if result is not None else None
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO items (key, status, attempts, updated) "
+                            "VALUES (?, ?, 0, 0)", (key, status))
+            self.db.execute("UPDATE items SET status = ?, attempts = attempts + ?, result = ?, "
+                            "error = ?, updated = ? WHERE key = ?",
+                            (status, attempts, data, error, time.time(), key))
+            self.db.commit()
+
+
+    def counts(self):
+        """Returns the number of items in each status"""
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM items GROUP BY status"))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+
+def query_key(query, extra=None):
+    """Returns a key identifying a query dictionary, which does not change with case,
+       accents, punctuation or the order of identifiers. Anything else that changes the
+       answer, like the sources asked, goes in extra."""
+    def norm(txt):
+        return re.sub('\W+', ' ', strip_accents(txt).lower(), flags=re.UNICODE).strip()
+
+    d = {}
+    for k, v in query.items():
+        if not v: continue
+        if k == 'title':     d[k] = norm(v)
+        elif k == 'authors': d[k] = [norm(surname(a)) for a in v]
+        else:                d[k] = v.strip().lower()
+
+    data = json.dumps([d, extra], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division, print_function)
+
+import argparse
+import csv
+import io
+import json
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+from .arxiv import Arxiv
+from .mathscinet import Mathscinet
+from .zentralblatt import Zentralblatt
+from .corpus import Corpus
+from .jobs import WorkerPool
+from .metrics import Histogram
+from .replay import Cassette, ReplayBrowser
+from .transport import build_opener
+from .server import StandInServer, point
+
+# Load generator replaying the lookups of a calibre library through the netbib
+# workers, as the identify method of the plugins does. Books come from a calibre
+# metadata.db, a csv or json export, or the synthetic corpus. Responses come from a
+# cassette, a stand-in server, or the real sites. For example
+#
+#   python -m netbib.loadgen --synthetic 500 --standin --latency 0.05 --concurrency 16
+#   python -m netbib.loadgen ~/Calibre/metadata.db --server http://127.0.0.1:8000
+#
+# At the end it reports the throughput, latency percentiles, requests per source and
+# how often each source found a match.
+
+sources = {'arxiv': Arxiv, 'mathscinet': Mathscinet, 'zentralblatt': Zentralblatt}
+
+# Identifiers looked up in the cross reference map, as in MySource.xref_keys
+xref_keys = ['arxiv', 'mr', 'zbl']
+
+
+
+# Reading books
+# ------------------------------ #
+
+def read_books(path):
+    """Returns the books in a calibre metadata.db, or in a csv or json export with title,
+       authors and identifiers, as dictionaries with those keys"""
+    if path.endswith('.db'):   return read_metadata_db(path)
+    if path.endswith('.csv'):  return read_csv(path)
+    if path.endswith('.json'): return read_json(path)
+    raise ValueError("Don't know how to read books from %s" % path)
+
+
+def read_metadata_db(path):
+    conn = sqlite3.connect(path)
+    try:
+        books = {}
+        for bid, title in conn.execute('SELECT id, title FROM books ORDER BY id'):
+            books[bid] = {'title': title, 'authors': [], 'identifiers': {}}
+
+        for bid, name in conn.execute('SELECT l.book, a.name FROM books_authors_link l '
+                                      'JOIN authors a ON a.id = l.author ORDER BY l.id'):
+            if bid in books: books[bid]['authors'].append(name.replace('|', ','))
+
+        for bid, typ, val in conn.execute('SELECT book, type, val FROM identifiers'):
+            if bid in books: books[bid]['identifiers'][typ] = val
+
+        return [books[bid] for bid in sorted(books.keys())]
+    finally:
+        conn.close()
+
+
+def parse_authors(authors):
+    if isinstance(authors, list): return authors
+    return [a.strip() for a in (authors or '').split('&') if len(a.strip()) > 0]
+
+
+def parse_identifiers(ids):
+    if isinstance(ids, dict): return ids
+    ans = {}
+    for item in (ids or '').split(','):
+        if ':' in item:
+            k, v = item.split(':', 1)
+            ans[k.strip()] = v.strip()
+    return ans
+
+
+def read_csv(path):
+    if sys.version_info[0] >= 3:
+        fd = io.open(path, 'r', encoding='utf-8-sig', newline='')
+    else:
+        fd = open(path, 'rb')
+
+    with fd:
+        books = []
+        for row in csv.DictReader(fd):
+            if sys.version_info[0] < 3:
+                row = dict((k.decode('utf-8-sig'), (v or b'').decode('utf-8')) for k, v in row.items())
+            books.append({'title': row.get('title', None),
+                          'authors': parse_authors(row.get('authors', None)),
+                          'identifiers': parse_identifiers(row.get('identifiers', None))})
+        return books
+
+
+def read_json(path):
+    with io.open(path, 'r', encoding='utf-8') as fd:
+        data = json.load(fd)
+
+    return [{'title': d.get('title', None),
+             'authors': parse_authors(d.get('authors', None)),
+             'identifiers': parse_identifiers(d.get('identifiers', None))} for d in data]
+
+
+def synthetic_books(corpus, n, id_ratio=0.3, seed=0):
+    """Returns n books from the corpus, each identifier being known with probability
+       id_ratio"""
+    rnd = random.Random(seed)
+    books = []
+    for i in range(n):
+        p = corpus.papers[i % len(corpus.papers)]
+        ids = {}
+        for k, scheme in [('arxiv', 'arxiv'), ('mr', 'mr'), ('zbl', 'zbl'), ('doi', 'doi')]:
+            if rnd.random() < id_ratio: ids[k] = p[scheme]
+        books.append({'title': p['title'], 'authors': list(p['authors']), 'identifiers': ids})
+    return books
+
+
+def book_query(book, idkey):
+    """Builds the query dictionary for a book, as MySource.identify does"""
+    identifiers = book.get('identifiers', {})
+    d = {}
+    for k, key in [(idkey, 'id'), ('isbn', 'isbn'), ('doi', 'doi')]:
+        if identifiers.get(k, None): d[key] = identifiers[k]
+
+    for k in xref_keys:
+        if k != idkey and identifiers.get(k, None):
+            d[k] = identifiers[k]
+
+    if book.get('title', None): d['title'] = book['title']
+    if book.get('authors', None): d['authors'] = book['authors']
+    return d
+
+
+
+# Running the load
+# ------------------------------ #
+
+def same_id(a, b):
+    """Whether two ids are the same, ignoring the version of arxiv ids"""
+    if not a or not b: return False
+    return re.sub('v\d+$', '', a.strip()) == re.sub('v\d+$', '', b.strip())
+
+
+class LoadReport(object):
+    """Outcome of a load run: latencies, requests and matches by source"""
+
+    def __init__(self, names):
+        self.names = names
+        self.books = 0
+        self.elapsed = 0
+        self.latency = Histogram(size=100000)
+        self.source_latency = dict((name, Histogram(size=100000)) for name in names)
+        self.counts = dict((name, {'queries': 0, 'matched': 0, 'confirmed': 0, 'known': 0,
+                                   'requests': 0, 'retries': 0, 'errors': 0, 'expired': 0})
+                           for name in names)
+        self.lock = threading.Lock()
+
+
+    def add(self, name, job, known_id, elapsed):
+        with self.lock:
+            c = self.counts[name]
+            c['queries'] = c['queries'] + 1
+            c['requests'] = c['requests'] + job.stats.get('network', 'requests')
+            c['retries'] = c['retries'] + job.retries
+            if job.error: c['errors'] = c['errors'] + 1
+            if job.expired: c['expired'] = c['expired'] + 1
+            if job.ans: c['matched'] = c['matched'] + 1
+
+            # Books with a known id for the source tell whether the top match is right
+            if known_id:
+                c['known'] = c['known'] + 1
+                if job.ans and same_id(job.ans[0].get('id', None), known_id):
+                    c['confirmed'] = c['confirmed'] + 1
+
+            self.source_latency[name].observe(elapsed)
+
+
+    def add_book(self, elapsed):
+        with self.lock:
+            self.books = self.books + 1
+            self.latency.observe(elapsed)
+
+
+    def as_dict(self):
+        def quantiles(h):
+            return dict(('p%d' % int(100*q), h.quantile(q)) for q in [0.5, 0.9, 0.95, 0.99, 1])
+
+        with self.lock:
+            return {'books': self.books,
+                    'elapsed': self.elapsed,
+                    'books_per_minute': 60 * self.books / self.elapsed if self.elapsed else None,
+                    'latency': quantiles(self.latency),
+                    'sources': dict((name, dict(self.counts[name],
+                                                latency=quantiles(self.source_latency[name])))
+                                    for name in self.names)}
+
+
+    def summary(self):
+        d = self.as_dict()
+        def ms(v): return '%8.0f' % (1000 * v) if v is not None else '%8s' % '-'
+        def pct(a, b): return '%6.1f%%' % (100 * a / b) if b else '%7s' % '-'
+
+        lines = ['%d books in %.1fs, %.1f books/minute' %
+                 (d['books'], d['elapsed'], d['books_per_minute'] or 0),
+                 '',
+                 '%-14s %8s %8s %8s %8s %8s' % ('latency ms', 'p50', 'p90', 'p95', 'p99', 'max'),
+                 '%-14s %s' % ('book', ' '.join(ms(d['latency'][k])
+                                                for k in ['p50', 'p90', 'p95', 'p99', 'p100']))]
+        for name in self.names:
+            q = d['sources'][name]['latency']
+            lines.append('%-14s %s' % (name, ' '.join(ms(q[k])
+                                                      for k in ['p50', 'p90', 'p95', 'p99', 'p100'])))
+
+        lines.extend(['', '%-14s %8s %8s %8s %8s %8s %8s %8s' %
+                      ('source', 'queries', 'requests', 'retries', 'errors', 'expired',
+                       'matched', 'correct')])
+        for name in self.names:
+            c = d['sources'][name]
+            lines.append('%-14s %8d %8d %8d %8d %8d %s %s' %
+                         (name, c['queries'], c['requests'], c['retries'], c['errors'],
+                          c['expired'], pct(c['matched'], c['queries']),
+                          pct(c['confirmed'], c['known'])))
+        return '\n'.join(lines)
+
+
+
+def run_load(books, workers, concurrency=8, timeout=30, progress=None):
+    """Looks up books on all workers, a dict of netbib sources by name, from concurrency
+       threads at a time. Each book is queried on all sources at once, as calibre does.
+       Returns a LoadReport."""
+    report = LoadReport(sorted(workers.keys()))
+    pending = queue.Queue()
+    for book in books: pending.put(book)
+
+    def client():
+        while True:
+            try: book = pending.get_nowait()
+            except queue.Empty: return
+
+            start = time.time()
+            jobs = []
+            for name in report.names:
+                src = workers[name]
+                jobs.append((name, src.idkey,
+                             src.query(book_query(book, src.idkey), timeout=timeout,
+                                       deadline=start + timeout)))
+
+            for name, idkey, job in jobs:
+                job.wait()
+                report.add(name, job, book.get('identifiers', {}).get(idkey, None),
+                           job.stats.elapsed or time.time() - start)
+
+            report.add_book(time.time() - start)
+            if progress: progress(report)
+
+    start = time.time()
+    threads = [threading.Thread(target=client, name='netbib-load-%d' % i)
+               for i in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive(): t.join(1)
+
+    report.elapsed = time.time() - start
+    return report
+
+
+def make_workers(names, browser, concurrency, base_url=None):
+    """Creates the netbib sources, with pools large enough for the concurrency"""
+    pool = WorkerPool(concurrency * len(names), 'netbib-load-query')
+    fetch_pool = WorkerPool(concurrency * 3, 'netbib-load-fetch')
+
+    workers = {}
+    for name in names:
+        src = sources[name](browser)
+        src.pool = pool
+        src.fetch_pool = fetch_pool
+        if base_url: point(src, base_url)
+        workers[name] = src
+    return workers
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m netbib.loadgen',
+                                     description='Replays the lookups of a calibre library through netbib')
+    parser.add_argument('library', nargs='?', help='calibre metadata.db, or a csv or json export')
+    parser.add_argument('--synthetic', type=int, help='look up this many books from the synthetic corpus')
+    parser.add_argument('--limit', type=int, help='look up at most this many books')
+    parser.add_argument('--sources', default='arxiv,mathscinet,zentralblatt')
+    parser.add_argument('--concurrency', type=int, default=8, help='books looked up at a time')
+    parser.add_argument('--timeout', type=float, default=30, help='deadline for each book, in seconds')
+    parser.add_argument('--cassette', help='serve responses from this cassette')
+    parser.add_argument('--server', help='base url of a running stand-in server')
+    parser.add_argument('--standin', action='store_true', help='start a stand-in server on the synthetic corpus')
+    parser.add_argument('--size', type=int, default=1000, help='papers in the synthetic corpus')
+    parser.add_argument('--latency', type=float, default=0, help='latency of the stand-in server or cassette')
+    parser.add_argument('--error-rate', type=float, default=0, help='error rate of the stand-in server')
+    parser.add_argument('--rate-limit', type=float, help='rate limit of the stand-in server')
+    parser.add_argument('--json', help='write the report as json to this file')
+    args = parser.parse_args(argv)
+
+    corpus = Corpus(args.size)
+    if args.library: books = read_books(args.library)
+    elif args.synthetic: books = synthetic_books(corpus, args.synthetic)
+    else: parser.error('Give a library or --synthetic')
+    if args.limit: books = books[:args.limit]
+
+    server = None
+    base_url = args.server
+    if args.standin:
+        server = StandInServer(corpus, latency=args.latency, error_rate=args.error_rate,
+                               rate_limit=args.rate_limit).start()
+        base_url = server.base_url
+
+    if args.cassette: browser = ReplayBrowser(Cassette.load(args.cassette), latency=args.latency)
+    else:             browser = build_opener()
+
+    workers = make_workers(args.sources.split(','), browser, args.concurrency, base_url)
+
+    def progress(report):
+        if report.books % 50 == 0 or report.books == len(books):
+            sys.stderr.write('\r%d/%d books' % (report.books, len(books)))
+            sys.stderr.flush()
+
+    report = run_load(books, workers, args.concurrency, args.timeout, progress)
+    sys.stderr.write('\n')
+    if server: server.stop()
+
+    print(report.summary())
+    if args.json:
+        data = json.dumps(report.as_dict(), indent=2, sort_keys=True)
+        if isinstance(data, bytes): data = data.decode('utf-8')
+        with io.open(args.json, 'w', encoding='utf-8') as fd:
+            fd.write(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,16 +34,60 @@ from .latex_encoding import latex_decode
 from .utils import surname, metadata_distance, strip_accents
 from .bibtexparser import parse_bibtex
 from .base import NetbibBase, NetbibError
+from .abstract import Converter
+from .extract import Blocks
+
+
+review = Converter('<div class="review">', '<br\s*/>\s*&nbsp;\s*&nbsp;',
+                   tags={('span', 'class="it"'):      ('<i>', '</i>'),
+                         ('span', 'class="bf"'):      ('<b>', '</b>'),
+                         ('span', 'class="MathTeX"'): ('', '')},
+                   skip=[('script', 'type="math/tex"')])
+
 
 class MathscinetError(NetbibError):
     pass
 
 
+
+class Matches(object):
+    """Parses the entries in the <pre> blocks of a results page while it downloads, as
+       a sink for fetch. Each entry is provided to the job as soon as its block is
+       complete."""
+
+    def __init__(self, source, job):
+        self.source = source
+        self.job = job
+        self.reset()
+
+
+    def reset(self):
+        self.blocks = Blocks('<div class="doc">', '<pre>', '</pre>', '</div>')
+        self.ans = []
+
+
+    def feed(self, data):
+        self.parse(self.blocks.feed(data))
+
+
+    def close(self):
+        self.parse(self.blocks.close())
+
+
+    def parse(self, blocks):
+        for entry in blocks:
+            for bib in parse_bibtex(entry):
+                d = self.source.entry_from_bibtex(bib)
+                self.job.provide(d)
+                self.ans.append(d)
+
+
+
 class Mathscinet(NetbibBase):
     def __init__(self, browser, timeout=30):
         super(Mathscinet, self).__init__()
 
-        self.search_fields = ['title', 'authors', 'id']
+        self.search_fields = ['title', 'authors', 'id', 'doi']
         self.idkey = 'mr'
 
         self.timeout = timeout
@@ -51,7 +95,7 @@ class Mathscinet(NetbibBase):
         self.sleep_time = 0.2
 
         self.url = "http://www.ams.org/mathscinet/search/publications.html"
-        self.ans = []
+        self.url_abstract = "http://www.ams.org/mathscinet/search/publdoc.html"
 
 
     # Internals
@@ -79,25 +123,20 @@ class Mathscinet(NetbibBase):
         return d
 
 
-    def get_matches(self, params):
+    def get_matches(self, params, job):
         query_list = '%s?%s' % (self.url, urlencode(params))
-        raw = self.browser.open(query_list, timeout=self.timeout).read()
-        rawdata = raw.decode('utf-8', errors='replace').strip()
+        matches = Matches(self, job)
+        self.fetch(query_list, job, matches)
+        return matches.ans
 
-        m = re.search('<div class="doc">(.*?)</div>', rawdata, re.DOTALL)
-        if m: rawdata = m.group(1)
-        else: return []
 
-        ans = []
-        for entry in re.findall('<pre>(.*?)</pre>', rawdata, re.DOTALL):
-            for bib in parse_bibtex(entry):
-                ans.append(self.entry_from_bibtex(bib))
-        return ans
+    def get_item(self, bibid, job):
+        return self.shared(('mathscinet-item', bibid), job, self.fetch_item, bibid, job)
 
 
-    def get_item(self, bibid):
+    def fetch_item(self, bibid, job):
         params = self.format_query({'id': bibid})
-        ans = self.get_matches(params)
+        ans = self.get_matches(params, job)
 
         if len(ans) > 0:
             return ans[0]
@@ -105,22 +144,17 @@ class Mathscinet(NetbibBase):
         return None
 
 
-    def get_abstract(self, bibid):
-        query_abstract = "http://www.ams.org/mathscinet/search/publdoc.html?pg1=MR&s1=%s" % bibid
-        raw = self.browser.open(query_abstract, timeout=self.timeout).read()
-        rawdata = raw.decode('utf-8', errors='replace').strip()
-        m = re.search('<div class="review">(.*?)</div>', rawdata, re.DOTALL)
-        if m:
-            abstract = m.group(1).strip()
-            L = re.findall("(.*?)<br\s*/>\s*&nbsp;\s*&nbsp;",
-                           abstract + '<br />&nbsp;&nbsp;', re.DOTALL)
-            Lpar = [self.format_abstract_paragraph(par.strip()) for par in L if len(par.strip()) > 0]
-            abstract = ('\n'.join(Lpar)).strip()
+    def get_abstract(self, bibid, job):
+        query_abstract = "%s?pg1=MR&s1=%s" % (self.url_abstract, bibid)
+        raw = self.fetch(query_abstract, job)
 
-            if len(abstract) > 0:
-                return abstract
+        with job.stage('extract'):
+            return self.extract_abstract(raw)
 
-        return None
+
+    def extract_abstract(self, rawdata):
+        """Extracts the review from a publdoc page as html paragraphs"""
+        return review(rawdata)
 
 
     def append_query_token(self, params, idx, field, value):
@@ -140,6 +174,9 @@ class Mathscinet(NetbibBase):
         if 'id' in d.keys():
             self.append_query_token(params, idx, 'MR', d['id'])
 
+        elif 'doi' in d.keys():
+            self.append_query_token(params, idx, 'ALLF', '"%s"' % d['doi'])
+
         elif 'authors' in d.keys() or 'title' in d.keys():
             if 'title' in d.keys():
                 if lax: KEY='ALLF'
@@ -189,13 +226,3 @@ class Mathscinet(NetbibBase):
         else:
             return (None, None)
 
-
-    def format_abstract_paragraph(self, par):
-        par = re.sub('\s+', ' ', par)
-        par = re.sub('<span\s+class="it">(.*?)</span>', '<i>\g<1></i>', par, re.DOTALL | re.MULTILINE)
-        par = re.sub('<span\s+class="bf">(.*?)</span>', '<b>\g<1></b>', par, re.DOTALL | re.MULTILINE)
-        par = re.sub('<span\s+class="it">(.*?)</span>', '<i>\g<1></i>', par, re.DOTALL | re.MULTILINE)
-        par = re.sub('<span\s+class="MathTeX">(.*?)</span>', '\g<1>', par, re.DOTALL | re.MULTILINE)
-        par = re.sub('<script\s+type="math/tex">(.*?)</script>', '', par, re.DOTALL | re.MULTILINE)
-
-        return '<p>%s</p>' % par.strip()
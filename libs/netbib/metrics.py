@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import os
+import random
+import socket
+import threading
+
+from . import stats
+
+
+
+class Histogram(object):
+    """Distribution of observed values. Keeps count and sum, and a uniform random sample
+       of at most size values to estimate quantiles."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.count = 0
+        self.sum = 0.
+        self.sample = []
+
+
+    def observe(self, value):
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            i = random.randint(0, self.count - 1)
+            if i < self.size: self.sample[i] = value
+
+
+    def quantile(self, q):
+        if len(self.sample) == 0: return None
+        L = sorted(self.sample)
+        return L[min(len(L) - 1, int(q * len(L)))]
+
+
+
+class MetricsRegistry(object):
+    """In process metrics: histograms and counters, each identified by a name and a
+       set of labels. Can be exported in prometheus text format, and observations can be
+       forwarded to sinks, like a StatsdSink."""
+
+    quantiles = [0.5, 0.95, 0.99]
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.sinks = []
+        self.lock = threading.Lock()
+
+
+
+    # Public interface
+    # ------------------------------ #
+
+    def observe(self, name, value, **labels):
+        """Adds an observation to histogram name"""
+        key = (name, self.label_key(labels))
+        with self.lock:
+            if not key in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+
+
+    def inc(self, name, n=1, **labels):
+        """Increments counter name"""
+        key = (name, self.label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+        for sink in self.sinks:
+            sink.inc(name, n, labels)
+
+
+    def get_counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, self.label_key(labels)), 0)
+
+
+    def get_quantiles(self, name, **labels):
+        """Returns a dictionary with the p50, p95 and p99 of histogram name"""
+        with self.lock:
+            h = self.histograms.get((name, self.label_key(labels)), None)
+            if h is None: return {}
+            return dict(('p%d' % int(100*q), h.quantile(q)) for q in self.quantiles)
+
+
+    def to_prometheus(self, prefix='netbib'):
+        """Returns the metrics in prometheus text exposition format. Histograms are
+           exported as summaries with the p50, p95 and p99 quantiles."""
+        lines = []
+        with self.lock:
+            names = sorted(set(name for name, labels in self.histograms))
+            for name in names:
+                metric = '%s_%s' % (prefix, name)
+                lines.append('# TYPE %s summary' % metric)
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name: continue
+                    for q in self.quantiles:
+                        value = h.quantile(q)
+                        lines.append('%s%s %s' % (metric,
+                                                  self.format_labels(labels + (('quantile', str(q)),)),
+                                                  self.format_value(value)))
+                    lines.append('%s_sum%s %s' % (metric, self.format_labels(labels),
+                                                  self.format_value(h.sum)))
+                    lines.append('%s_count%s %d' % (metric, self.format_labels(labels), h.count))
+
+            names = sorted(set(name for name, labels in self.counters))
+            for name in names:
+                metric = '%s_%s_total' % (prefix, name)
+                lines.append('# TYPE %s counter' % metric)
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n != name: continue
+                    lines.append('%s%s %d' % (metric, self.format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def write_prometheus(self, path, prefix='netbib'):
+        """Writes the metrics to path in prometheus text format, as the node exporter
+           textfile collector expects. The file is replaced atomically."""
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as fd:
+            fd.write(self.to_prometheus(prefix))
+        os.rename(tmp, path)
+
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+
+
+    # Internals
+    # ------------------------------ #
+
+    def label_key(self, labels):
+        return tuple(sorted((k, '%s' % v) for k, v in labels.items() if v is not None))
+
+
+    def format_labels(self, labels):
+        if len(labels) == 0: return ''
+        items = ['%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]
+        return '{%s}' % ','.join(items)
+
+
+    def format_value(self, value):
+        if value is None: return 'NaN'
+        return '%.6f' % value
+
+
+
+class StatsdSink(object):
+    """Forwards observations to a statsd daemon over udp. Histograms become timers in
+       milliseconds, and labels are appended to the metric name."""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='netbib'):
+        self.addr = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+    def observe(self, name, value, labels):
+        self.send('%s:%d|ms' % (self.metric(name, labels), int(1000 * value)))
+
+
+    def inc(self, name, n, labels):
+        self.send('%s:%d|c' % (self.metric(name, labels), n))
+
+
+    def metric(self, name, labels):
+        parts = [self.prefix, name] + ['%s' % labels[k] for k in sorted(labels)
+                                       if labels[k] is not None]
+        return '.'.join(p.replace('.', '_').replace(':', '_') for p in parts)
+
+
+    def send(self, line):
+        try:
+            self.sock.sendto(line.encode('utf-8'), self.addr)
+        except (socket.error, OSError):
+            pass
+
+
+
+registry = MetricsRegistry()
+
+
+def record_query(st):
+    """Stats hook feeding the registry with a finished query"""
+    labels = {'source': st.source, 'plan': st.plan or 'none'}
+    registry.observe('query_seconds', st.elapsed or 0, **labels)
+
+    parse = sum(st.get(stage) for stage in ['decode', 'extract', 'bibtex', 'normalize'])
+    registry.observe('parse_seconds', parse, **labels)
+
+    registry.inc('queries', **labels)
+    if st.retries: registry.inc('retries', st.retries, source=st.source)
+    if st.expired: registry.inc('expired', source=st.source)
+    if st.cancelled: registry.inc('cancelled', source=st.source)
+    if st.error: registry.inc('errors', source=st.source)
+
+
+stats.add_hook(record_query)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+try:
+    from sys import intern
+except ImportError:
+    intern = lambda s: s            # Python 2 only interns byte strings
+
+
+
+class Lazy(object):
+    """A field value that is computed as fn(*args) the first time it is read"""
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+
+    def __call__(self):
+        return self.fn(*self.args)
+
+
+    def __repr__(self):
+        return 'Lazy(%s)' % getattr(self.fn, '__name__', self.fn)
+
+
+
+class Record(object):
+    """A result of a netbib source. Behaves like the dictionary it replaces, but keeps
+       the usual fields in slots and the authors in a tuple, which takes a fraction of
+       the memory of a dict. A field is present once set; any other key goes in an
+       overflow dictionary with an interned name."""
+
+    fields = ('id', 'type', 'title', 'authors', 'subject', 'doi', 'isbn', 'url', 'updated',
+              'year', 'language', 'publisher', 'journal', 'volume', 'number', 'series',
+              'series_index', 'abstract')
+
+    __slots__ = fields + ('extra',)
+    names = frozenset(fields)
+
+    def __init__(self, *args, **kwargs):
+        self.update(*args, **kwargs)
+
+
+
+    # Mapping interface
+    # ------------------------------ #
+
+    def __getitem__(self, key):
+        if key in Record.names:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            extra = getattr(self, 'extra', None)
+            if extra is None: raise KeyError(key)
+            value = extra[key]
+
+        if value.__class__ is Lazy:
+            self[key] = value()
+            return self[key]
+        return value
+
+
+    def __setitem__(self, key, value):
+        if key == 'authors' and isinstance(value, list):
+            value = tuple(value)
+
+        if key in Record.names:
+            setattr(self, key, value)
+            return
+
+        extra = getattr(self, 'extra', None)
+        if extra is None:
+            extra = {}
+            self.extra = extra
+        extra[intern(key)] = value
+
+
+    def __delitem__(self, key):
+        if key in Record.names:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+            return
+
+        extra = getattr(self, 'extra', None)
+        if extra is None: raise KeyError(key)
+        del extra[key]
+
+
+    def __contains__(self, key):
+        if key in Record.names: return hasattr(self, key)
+        extra = getattr(self, 'extra', None)
+        return extra is not None and key in extra
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __eq__(self, other):
+        if not isinstance(other, (dict, Record)): return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+
+    def __ne__(self, other):
+        ans = self.__eq__(other)
+        if ans is NotImplemented: return ans
+        return not ans
+
+
+    __hash__ = None
+
+
+    def __repr__(self):
+        return 'Record(%r)' % dict(self.items())
+
+
+    def __getstate__(self):
+        return dict(self.items())
+
+
+    def __setstate__(self, state):
+        self.update(state)
+
+
+    def keys(self):
+        L = [k for k in Record.fields if hasattr(self, k)]
+        extra = getattr(self, 'extra', None)
+        if extra: L.extend(extra.keys())
+        return L
+
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def setdefault(self, key, default=None):
+        if not key in self: self[key] = default
+        return self[key]
+
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default: return default[0]
+            raise
+        del self[key]
+        return value
+
+
+    def update(self, *args, **kwargs):
+        for d in args + (kwargs,):
+            pairs = d.items() if hasattr(d, 'items') else d
+            for k, v in pairs:
+                self[k] = v
+
+
+    def copy(self):
+        """Returns a shallow copy, keeping the fields that are not computed yet lazy"""
+        ans = Record()
+        for k in Record.fields:
+            if hasattr(self, k): setattr(ans, k, getattr(self, k))
+
+        extra = getattr(self, 'extra', None)
+        if extra: ans.extra = dict(extra)
+        return ans
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import base64
+import io
+import json
+import os
+import random
+import sys
+import threading
+
+if sys.version_info[0] >= 3:
+    from urllib.error import HTTPError
+    from email.message import Message
+else:
+    from urllib2 import HTTPError
+    from mimetools import Message
+
+from .errors import NetbibError
+from .transport import canonical_url
+
+
+
+class CassetteError(NetbibError):
+    pass
+
+
+
+class Cassette(object):
+    """A set of recorded http responses, keyed by canonical url and stored as a json
+       file. Responses to the same url are replayed in the order they were recorded,
+       repeating the last one."""
+
+    version = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.interactions = {}
+        self.replayed = {}
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def load(cls, path):
+        """Loads a cassette from path"""
+        cassette = cls(path)
+        with io.open(path, 'r', encoding='utf-8') as fd:
+            data = json.load(fd)
+
+        if data.get('version', None) != cls.version:
+            raise CassetteError("Unsupported cassette version in %s: %s" %
+                                (path, data.get('version', None)))
+
+        for it in data['interactions']:
+            cassette.interactions.setdefault(it['url'], []).append(it)
+        return cassette
+
+
+    def save(self, path=None):
+        """Writes the cassette to path, atomically"""
+        path = path or self.path
+        with self.lock:
+            interactions = [it for L in self.interactions.values() for it in L]
+
+        interactions.sort(key=lambda it: it['url'])
+        data = json.dumps({'version': self.version, 'interactions': interactions},
+                          indent=1, sort_keys=True, ensure_ascii=False)
+        if isinstance(data, bytes): data = data.decode('utf-8')
+
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as fd:
+            fd.write(data)
+        os.rename(tmp, path)
+
+
+    def add(self, url, body, status=200, headers=None):
+        """Records a response"""
+        it = {'url': canonical_url(url), 'status': status, 'headers': headers or {}}
+        try:
+            it['body'] = body.decode('utf-8')
+            it['encoding'] = 'utf-8'
+        except UnicodeDecodeError:
+            it['body'] = base64.b64encode(body).decode('ascii')
+            it['encoding'] = 'base64'
+
+        with self.lock:
+            self.interactions.setdefault(it['url'], []).append(it)
+
+
+    def get(self, url):
+        """Returns the next recorded interaction for url, or None"""
+        key = canonical_url(url)
+        with self.lock:
+            L = self.interactions.get(key, [])
+            if len(L) == 0: return None
+            i = self.replayed.get(key, 0)
+            self.replayed[key] = i + 1
+            return L[min(i, len(L) - 1)]
+
+
+    def body(self, it):
+        if it.get('encoding', 'utf-8') == 'base64':
+            return base64.b64decode(it['body'])
+        return it['body'].encode('utf-8')
+
+
+
+class ReplayResponse(object):
+    """File like response serving a recorded body. The injected latency is spent on the
+       first read, and closing the response interrupts it."""
+
+    def __init__(self, url, body, latency=0):
+        self.url = url
+        self.fd = io.BytesIO(body)
+        self.latency = latency
+        self.closed = threading.Event()
+
+
+    def read(self, n=-1):
+        if self.latency > 0:
+            self.closed.wait(self.latency)
+            self.latency = 0
+
+        if self.closed.is_set():
+            raise ValueError("Read from closed response")
+
+        return self.fd.read(n)
+
+
+    def geturl(self):
+        return self.url
+
+
+    def close(self):
+        self.closed.set()
+
+
+
+class ReplayBrowser(object):
+    """Browser serving responses from a cassette, with an optional injected latency of
+       latency seconds plus a random jitter of up to jitter seconds. The jitter comes
+       from a seeded generator, so runs are repeatable. Urls not in the cassette raise
+       CassetteError."""
+
+    def __init__(self, cassette, latency=0, jitter=0, seed=0):
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+
+    def clone_browser(self):
+        return self
+
+
+    def open(self, url, timeout=None):
+        it = self.cassette.get(url)
+        if it is None:
+            raise CassetteError("No recorded response for %s" % url)
+
+        with self.lock:
+            latency = self.latency + self.jitter * self.random.random()
+
+        body = self.cassette.body(it)
+        if it['status'] != 200:
+            raise HTTPError(url, it['status'], 'Recorded error', make_headers(it['headers']),
+                            io.BytesIO(body))
+
+        return ReplayResponse(url, body, latency)
+
+
+
+class RecordingBrowser(object):
+    """Wraps a browser and records every response into a cassette, which is saved
+       after each request."""
+
+    def __init__(self, browser, cassette):
+        self.browser = browser
+        self.cassette = cassette
+
+
+    def clone_browser(self):
+        clone = getattr(self.browser, 'clone_browser', None)
+        if clone: return RecordingBrowser(clone(), self.cassette)
+        return self
+
+
+    def open(self, url, timeout=None):
+        try:
+            resp = self.browser.open(url, timeout=timeout)
+        except HTTPError as e:
+            headers = {}
+            if e.info() is not None:
+                for k in ['Retry-After']:
+                    if e.info().get(k, None): headers[k] = e.info().get(k)
+            self.cassette.add(url, e.read() or b'', status=e.code, headers=headers)
+            self.cassette.save()
+            raise
+
+        body = resp.read()
+        self.cassette.add(url, body)
+        self.cassette.save()
+        return ReplayResponse(url, body)
+
+
+
+def make_headers(d):
+    """Builds a headers object like the one in urllib's HTTPError"""
+    if sys.version_info[0] >= 3:
+        headers = Message()
+        for k, v in d.items():
+            headers[k] = v
+        return headers
+
+    txt = ''.join('%s: %s\r\n' % (k, v) for k, v in d.items())
+    return Message(io.BytesIO(txt.encode('utf-8')))
+
+
+def browser_from_env(browser):
+    """Wraps browser for recording or replaying as requested by the environment.
+       NETBIB_RECORD=path records a new cassette at path. NETBIB_REPLAY=path serves
+       responses from it instead, with NETBIB_LATENCY seconds of injected latency."""
+    if os.environ.get('NETBIB_REPLAY', None):
+        latency = float(os.environ.get('NETBIB_LATENCY', '0'))
+        return ReplayBrowser(Cassette.load(os.environ['NETBIB_REPLAY']), latency=latency)
+
+    if os.environ.get('NETBIB_RECORD', None):
+        return RecordingBrowser(browser, Cassette(os.environ['NETBIB_RECORD']))
+
+    return browser
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import random
+import socket
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+from .errors import NetbibUnavailable
+from .metrics import registry
+
+
+
+class RetryPolicy(object):
+    """Decides which errors are worth retrying and how long to wait before each retry.
+       Waits grow exponentially with some jitter, and honour Retry-After headers."""
+
+    def __init__(self, retries=2, delay=0.5, factor=2, max_delay=8, max_retry_after=30):
+        self.retries = retries
+        self.delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+        self.transient_codes = set([408, 429, 500, 502, 503, 504])
+
+
+    def is_transient(self, err):
+        """Whether err is likely to go away by trying again"""
+        code = getattr(err, 'code', None)
+        if code is not None:
+            return code in self.transient_codes
+
+        return isinstance(err, (socket.timeout, socket.error, IOError, OSError))
+
+
+    def wait_time(self, attempt, err):
+        """Seconds to wait before retry number attempt, starting at 0. Returns None if
+           there should be no more retries."""
+        if attempt >= self.retries: return None
+
+        wait = min(self.max_delay, self.delay * self.factor ** attempt)
+        wait = wait * random.uniform(0.5, 1.0)
+
+        retry_after = self.retry_after(err)
+        if retry_after is not None:
+            if retry_after > self.max_retry_after: return None
+            wait = max(wait, retry_after)
+
+        return wait
+
+
+    def retry_after(self, err):
+        """Seconds requested by the Retry-After header of a 429 or 503 response"""
+        if getattr(err, 'code', None) not in [429, 503]: return None
+
+        try:
+            headers = err.info()
+            value = headers.get('Retry-After', None)
+        except Exception:
+            return None
+
+        if not value: return None
+        value = value.strip()
+
+        if value.isdigit():
+            return int(value)
+
+        date = parsedate_tz(value)
+        if date:
+            return max(0, mktime_tz(date) - time.time())
+
+        return None
+
+
+
+class CircuitBreaker(object):
+    """Tracks failures of requests to a host. After threshold failures in a row the
+       breaker opens, and requests fail right away for cooldown seconds. Then a single
+       trial request is let through, which closes the breaker if it succeeds. A trial
+       that ends without an outcome, because it was cancelled, must be released."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, threshold=5, cooldown=60):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+
+    def check(self):
+        """Raises NetbibUnavailable if requests to the host should not be attempted.
+           Returns True if the request is the trial of a half open breaker."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return False
+
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                return True
+
+        raise NetbibUnavailable("%s is unavailable, failing fast" % self.host)
+
+
+    def release(self):
+        """Ends a trial that recorded neither success nor failure, so that the next
+           request can be the trial"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+
+    def record_failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips = self.trips + 1
+                    registry.inc('breaker_trips', host=self.host)
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+    def status(self):
+        """Returns a dictionary describing the state of the breaker"""
+        with self.lock:
+            d = {'host': self.host,
+                 'state': self.state,
+                 'failures': self.failures,
+                 'trips': self.trips}
+
+            if self.state == self.OPEN:
+                d['retry_in'] = max(0, self.cooldown - (time.time() - self.opened_at))
+
+            return d
+
+
+
+class BreakerRegistry(object):
+    """One circuit breaker per host, shared by all sources"""
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+
+    def get(self, host):
+        with self.lock:
+            if not host in self.breakers:
+                self.breakers[host] = CircuitBreaker(host, self.threshold, self.cooldown)
+            return self.breakers[host]
+
+
+    def status(self):
+        """Returns the status of all breakers, keyed by host"""
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return dict((b.host, b.status()) for b in breakers)
+
+
+    def reset(self):
+        with self.lock:
+            self.breakers = {}
+
+
+
+class RateLimiter(object):
+    """Token bucket allowing rate requests per second, in bursts of up to burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+
+    def acquire(self):
+        """Takes a token, returning whether one was available"""
+        with self.lock:
+            self.refill()
+            if self.tokens < 1: return False
+            self.tokens = self.tokens - 1
+            return True
+
+
+    def reserve(self):
+        """Takes a token, possibly in advance. Returns the seconds to wait before the
+           request it pays for may be made."""
+        with self.lock:
+            self.refill()
+            self.tokens = self.tokens - 1
+            if self.tokens >= 0: return 0
+            return -self.tokens / self.rate
+
+
+
+breakers = BreakerRegistry()
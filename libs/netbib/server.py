@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division, print_function)
+
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+
+if sys.version_info[0] >= 3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+
+from .corpus import Corpus
+from .replay import Cassette
+from .resilience import RateLimiter
+
+# A local stand-in for the arxiv, mathscinet and zbmath endpoints, for load tests. Each
+# site is served under its own prefix, and point() sets the urls of a source to it:
+#
+#   /arxiv/api/query                          arxiv atom api
+#   /ams/mathscinet/search/publications.html  mathscinet search, fmt=bibtex
+#   /ams/mathscinet/search/publdoc.html       mathscinet reviews
+#   /zbmath/                                  zbmath search and document pages
+#   /zbmath/bibtex/<id>.bib                   zbmath bibtex
+#
+# Responses come from a synthetic corpus or, when given a cassette, are the recorded
+# ones of the real sites. Run it standalone with python -m netbib.server --help.
+
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        self.server.standin.handle(self)
+
+
+    def log_message(self, fmt, *args):
+        if self.server.standin.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+class StandInServer(object):
+    """Http server emulating arxiv, mathscinet and zbmath. Every request waits latency
+       seconds plus a random jitter of up to jitter seconds. A fraction error_rate of
+       the requests fail with a 503, and requests over rate_limit per second and site
+       get a 429. Both carry a Retry-After header of retry_after seconds."""
+
+    # Hosts of the real sites, by prefix
+    sites = {'arxiv': 'http://export.arxiv.org',
+             'ams': 'http://www.ams.org',
+             'zbmath': 'https://zbmath.org'}
+
+    def __init__(self, corpus=None, cassette=None, host='127.0.0.1', port=0, latency=0,
+                 jitter=0, error_rate=0, rate_limit=None, retry_after=1, seed=0,
+                 verbose=False):
+        self.corpus = corpus or Corpus()
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.verbose = verbose
+
+        self.random = random.Random(seed)
+        self.limiters = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), StandInHandler)
+        self.httpd.standin = self
+        self.thread = None
+
+
+
+    # Public interface
+    # ------------------------------ #
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+
+    def start(self):
+        """Serves requests from a background thread"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='netbib-server')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread: self.thread.join()
+
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+
+    def point(self, source):
+        """Points the urls of a netbib source to this server"""
+        return point(source, self.base_url)
+
+
+    def stats(self):
+        """Returns the counts of requests, by site and status"""
+        with self.lock:
+            return dict(self.counters)
+
+
+
+    # Internals
+    # ------------------------------ #
+
+    def count(self, site, status):
+        with self.lock:
+            key = (site, status)
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+
+    def limiter(self, site):
+        with self.lock:
+            if not site in self.limiters:
+                self.limiters[site] = RateLimiter(self.rate_limit)
+            return self.limiters[site]
+
+
+    def handle(self, req):
+        parts = urlsplit(req.path)
+        m = re.match('/([^/]+)(/.*)?$', parts.path)
+        site = m.group(1) if m else None
+        path = (m.group(2) if m else None) or '/'
+        params = dict(parse_qsl(parts.query, keep_blank_values=True))
+
+        if not site in self.sites:
+            return self.respond(req, site, 404, 'Not found')
+
+        with self.lock:
+            delay = self.latency + self.jitter * self.random.random()
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+
+        if self.rate_limit and not self.limiter(site).acquire():
+            return self.respond(req, site, 429, 'Too many requests',
+                                {'Retry-After': '%d' % self.retry_after})
+
+        if delay > 0: time.sleep(delay)
+
+        if fail:
+            return self.respond(req, site, 503, 'Service unavailable',
+                                {'Retry-After': '%d' % self.retry_after})
+
+        if self.cassette:
+            status, body = self.recorded(self.sites[site] + path, parts.query)
+        else:
+            status, body = self.synthetic(site, path, params)
+
+        self.respond(req, site, status, body)
+
+
+    def respond(self, req, site, status, body, headers=None):
+        if not isinstance(body, bytes): body = body.encode('utf-8')
+
+        self.count(site, status)
+        try:
+            req.send_response(status)
+            req.send_header('Content-Type', 'text/html; charset=utf-8')
+            req.send_header('Content-Length', '%d' % len(body))
+            for k, v in (headers or {}).items():
+                req.send_header(k, v)
+            req.end_headers()
+            req.wfile.write(body)
+        except EnvironmentError:
+            pass                  # The client went away
+
+
+    def recorded(self, url, query):
+        it = self.cassette.get('%s?%s' % (url, query) if query else url)
+        if it is None: return 404, 'Not recorded'
+        return it['status'], self.cassette.body(it)
+
+
+    def synthetic(self, site, path, params):
+        if site == 'arxiv' and path == '/api/query':
+            return 200, self.arxiv(params)
+
+        if site == 'ams' and path == '/mathscinet/search/publications.html':
+            return 200, self.corpus.mathscinet_page(self.mathscinet(params))
+
+        if site == 'ams' and path == '/mathscinet/search/publdoc.html':
+            p = self.corpus.get('mr', params.get('s1', ''))
+            if p: return 200, self.corpus.mathscinet_review(p)
+            return 200, '<html><body>No publications</body></html>'
+
+        if site == 'zbmath' and path.startswith('/bibtex/'):
+            p = self.corpus.get('zbl', path[len('/bibtex/'):-len('.bib')])
+            if p: return 200, self.corpus.zbmath_bibtex(p)
+            return 404, 'Not found'
+
+        if site == 'zbmath' and path == '/':
+            return 200, self.zbmath(params)
+
+        return 404, 'Not found'
+
+
+
+    # Emulation of the queries
+    # ------------------------------ #
+
+    def arxiv(self, params):
+        if 'id_list' in params:
+            ids = [re.sub('v\d+$', '', i.strip()) for i in params['id_list'].split(',')]
+            hits = [self.corpus.get('arxiv', i) for i in ids]
+            hits = [p for p in hits if p]
+        else:
+            title, authors = [], []
+            for item in params.get('search_query', '').split(' AND '):
+                m = re.match('(\w+):"?(.*?)"?$', item.strip())
+                if not m: continue
+                if m.group(1) == 'ti': title.append(m.group(2))
+                if m.group(1) == 'au': authors.append(m.group(2))
+            hits = self.corpus.search(' '.join(title), authors)
+
+        start = int(params.get('start', 0))
+        size = int(params.get('max_results', 10))
+        return self.corpus.arxiv_feed(hits[start:start+size], start, len(hits))
+
+
+    def mathscinet(self, params):
+        title, authors, lax = [], [], False
+        idx = 1
+        while 'pg%d' % idx in params:
+            field, value = params['pg%d' % idx], params.get('s%d' % idx, '').strip('"')
+            if field == 'MR':
+                p = self.corpus.get('mr', value)
+                return [p] if p else []
+            if field == 'ALLF' and self.corpus.get('doi', value):
+                return [self.corpus.get('doi', value)]
+            if field in ['TI', 'ALLF']: title.append(value)
+            if field == 'ALLF': lax = True
+            if field == 'ICN': authors.append(value)
+            idx = idx + 1
+
+        return self.corpus.search(' '.join(title), authors, lax=lax)
+
+
+    def zbmath(self, params):
+        title, authors, lax = [], [], False
+        for field, value in re.findall('(\w+):("[^"]*"|\S+)', params.get('q', '')):
+            value = value.strip('"')
+            if field == 'an':
+                p = self.corpus.get('zbl', value)
+                if p: return self.corpus.zbmath_document(p)
+                return self.corpus.zbmath_page([])
+            if field == 'en':
+                p = self.corpus.get('doi', value)
+                return self.corpus.zbmath_page([p] if p else [])
+            if field in ['ti', 'any']: title.append(value)
+            if field == 'any': lax = True
+            if field == 'au': authors.append(value)
+
+        return self.corpus.zbmath_page(self.corpus.search(' '.join(title), authors, lax=lax))
+
+
+
+def point(source, base):
+    """Points the urls of a netbib source to the stand-in server at base"""
+    if hasattr(source, 'arxiv_url'):
+        source.arxiv_url = base + '/arxiv/api/query'
+    if hasattr(source, 'url_abstract'):
+        source.url = base + '/ams/mathscinet/search/publications.html'
+        source.url_abstract = base + '/ams/mathscinet/search/publdoc.html'
+    if hasattr(source, 'url_bibtex'):
+        source.url_query = base + '/zbmath/'
+        source.url_bibtex = base + '/zbmath/bibtex'
+    return source
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m netbib.server',
+                                     description='Serves stand-ins for arxiv, mathscinet and zbmath')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cassette', help='serve these recorded responses, instead of the synthetic corpus')
+    parser.add_argument('--size', type=int, default=1000, help='papers in the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra latency, up to these seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with a 503')
+    parser.add_argument('--rate-limit', type=float, help='requests per second and site, beyond which 429 is returned')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv)
+
+    server = StandInServer(corpus=Corpus(args.size, args.seed),
+                           cassette=Cassette.load(args.cassette) if args.cassette else None,
+                           host=args.host, port=args.port, latency=args.latency,
+                           jitter=args.jitter, error_rate=args.error_rate,
+                           rate_limit=args.rate_limit, seed=args.seed, verbose=args.verbose)
+
+    print('Serving on %s' % server.base_url)
+    print('  arxiv_url    %s/arxiv/api/query' % server.base_url)
+    print('  url          %s/ams/mathscinet/search/publications.html' % server.base_url)
+    print('  url_abstract %s/ams/mathscinet/search/publdoc.html' % server.base_url)
+    print('  url_query    %s/zbmath/' % server.base_url)
+    print('  url_bibtex   %s/zbmath/bibtex' % server.base_url)
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
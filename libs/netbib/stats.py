@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+
+class QueryStats(object):
+    """Per query instrumentation. For each stage it keeps the time spent, the bytes
+       transferred, the number of requests and calls, and the number of results.
+
+       Stages are the query plans (id, xref, doi, strict, lax), ranking (rank) and
+       abstract enrichment (enrich), together with the work they are made of: network
+       requests (network), decoding responses (decode), regex, html and xml extraction
+       (extract), bibtex parsing (bibtex) and field normalization, which is mostly
+       latex_decode (normalize). The time of a plan includes the work inside it.
+       Plans that failed are kept in failures, with their errors."""
+
+    def __init__(self, source=None):
+        self.source = source
+        self.plan = None
+        self.started = time.time()
+        self.elapsed = None
+        self.retries = 0
+        self.expired = False
+        self.cancelled = False
+        self.error = None
+        self.failures = {}
+
+        self.stages = {}
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name):
+        """Accounts the time spent inside the with block to stage name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time=time.time() - start, calls=1)
+
+
+    def add(self, name, time=0, bytes=0, requests=0, results=0, calls=0):
+        """Adds the given amounts to the counters of stage name"""
+        with self.lock:
+            st = self.stages.setdefault(name, {'time': 0, 'bytes': 0, 'requests': 0,
+                                               'results': 0, 'calls': 0})
+            st['time'] = st['time'] + time
+            st['bytes'] = st['bytes'] + bytes
+            st['requests'] = st['requests'] + requests
+            st['results'] = st['results'] + results
+            st['calls'] = st['calls'] + calls
+
+
+    def fail(self, name, err):
+        """Records that stage name failed with the exception err"""
+        with self.lock:
+            self.failures[name] = repr(err)
+
+
+    def get(self, name, key='time'):
+        with self.lock:
+            return self.stages.get(name, {}).get(key, 0)
+
+
+    def timings(self):
+        """Returns a dictionary with the time spent in each stage"""
+        with self.lock:
+            return dict((k, v['time']) for k, v in self.stages.items())
+
+
+    def as_dict(self):
+        """Returns the stats as a plain dictionary, suitable for json"""
+        with self.lock:
+            return {'source': self.source,
+                    'plan': self.plan,
+                    'started': self.started,
+                    'elapsed': self.elapsed,
+                    'retries': self.retries,
+                    'expired': self.expired,
+                    'cancelled': self.cancelled,
+                    'error': self.error,
+                    'failures': dict(self.failures),
+                    'stages': dict((k, dict(v)) for k, v in self.stages.items())}
+
+
+    def summary(self):
+        """Returns a one line description of the stats"""
+        stages = ', '.join('%s %.2fs' % (k, v) for k, v in sorted(self.timings().items()))
+        return '%s: %.2fs plan=%s requests=%d bytes=%d retries=%d [%s]' % (
+            self.source, self.elapsed or 0, self.plan, self.get('network', 'requests'),
+            self.get('network', 'bytes'), self.retries, stages)
+
+
+
+# Hooks called with the QueryStats of every finished query
+hooks = []
+
+def add_hook(fn):
+    """Registers fn to be called with the QueryStats of every finished query"""
+    hooks.append(fn)
+
+
+def remove_hook(fn):
+    if fn in hooks:
+        hooks.remove(fn)
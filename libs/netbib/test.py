@@ -19,29 +19,28 @@
 
 from __future__ import (unicode_literals, division)
 
-import sys
-
-if sys.version_info[0] >= 3:
-    from urllib.request import build_opener
-else:
-    from urllib2 import build_opener
-
-
 from .zentralblatt import Zentralblatt
 from .mathscinet import Mathscinet
 from .arxiv import Arxiv
+from .replay import browser_from_env
+from .transport import build_opener
 # from .inspire import Inspire
 
+# Set NETBIB_RECORD=path to record the responses into a cassette, and NETBIB_REPLAY=path
+# to run the tests offline from it. NETBIB_LATENCY adds latency to replayed responses.
+
 
 def test_source(src, query):
-    ans = src.query_and_wait(query)
+    job = src.query(query)
+    ans = job.result()
     for d in ans:
         print('%s - %s' % (', '.join(d['authors']), d['title']))
+    print(job.stats.summary())
     print("")
 
 
 def test():
-    browser = build_opener()
+    browser = browser_from_env(build_opener())
 
     print("Arxiv")
     test_source(src=Arxiv(browser), query={'authors': ['Kontsevich']})
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import io
+import os
+import pickle
+import re
+import socket
+import sys
+import threading
+import time
+import unittest
+
+if sys.version_info[0] >= 3:
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+else:
+    from urllib2 import HTTPError
+    from urllib import urlencode
+
+from .jobs import Job, QueryJob, CancelToken, WorkerPool, abort_watcher
+from .transport import SingleFlight, abortable, build_opener, read_response
+from .resilience import BreakerRegistry
+from .replay import Cassette, ReplayBrowser
+from .xref import IdentifierMap
+from .arxiv import Arxiv
+from .mathscinet import Mathscinet, review
+from .zentralblatt import Zentralblatt
+from .bibtexparser import chop_bibtex, iter_bibtex, parse_bibtex_entry
+from .journal import Journal, query_key
+from .record import Record, Lazy
+from .corpus import msc_codes
+from .bench import legacy_msc_tags, legacy_subject_tags
+from .cli import Enricher, enrich_stream
+from .errors import NetbibCancelled, NetbibDeadline
+
+# Offline tests, which need neither the network nor calibre. Run from the libs
+# directory with
+#
+#   python -m unittest netbib.test_offline
+#
+# The sources are tested on the cassettes in libs/fixtures, recorded from the
+# synthetic corpus with 'make fixtures'.
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'fixtures')
+
+
+
+class JobTest(unittest.TestCase):
+    def test_wait_abort(self):
+        job = Job()
+        abort = threading.Event()
+        threading.Timer(0.1, abort.set).start()
+        self.assertFalse(job.wait(timeout=5, abort=abort))
+        self.assertTrue(abort.is_set())
+
+
+    def test_wait_leaves_no_threads(self):
+        before = threading.active_count()
+        for i in range(50):
+            job = Job()
+            threading.Timer(0.001, job.finish, kwargs={'ans': i}).start()
+            self.assertTrue(job.wait(timeout=5, abort=threading.Event()))
+            self.assertEqual(job.ans, i)
+
+        time.sleep(0.5)
+        self.assertIsNone(abort_watcher.thread)
+        self.assertLessEqual(threading.active_count(), before)
+
+
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+        # A server that accepts connections but never answers
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.url = 'http://127.0.0.1:%d/' % self.server.getsockname()[1]
+
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def test_cancel_before_response(self):
+        token = CancelToken()
+        threading.Timer(0.2, token.cancel).start()
+
+        start = time.time()
+        with abortable(token, 5):
+            self.assertRaises(Exception, build_opener().open, self.url, timeout=30)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(token.callbacks, [])
+
+        # Connections made elsewhere in the process are left alone
+        self.assertEqual(socket.create_connection.__module__, 'socket')
+
+
+    def test_deadline_while_reading(self):
+        class Trickle(object):
+            def read(self, size):
+                time.sleep(0.05)
+                return b'x'
+
+            def close(self):
+                pass
+
+        start = time.time()
+        self.assertRaises(NetbibDeadline, read_response, Trickle(), CancelToken(),
+                          deadline=start + 0.3)
+        self.assertLess(time.time() - start, 1)
+
+
+    def test_single_flight_counts(self):
+        flights = SingleFlight()
+        started = threading.Event()
+
+        def leader():
+            started.set()
+            time.sleep(0.2)
+            raise NetbibCancelled("Query cancelled")
+
+        t = threading.Thread(target=lambda: self.assertRaises(NetbibCancelled, flights.do, 'k', leader))
+        t.start()
+        started.wait(5)
+
+        # The follower waits for the cancelled leader, then does the call on its own
+        self.assertEqual(flights.do('k', lambda: 1, timeout=5), (1, False))
+        t.join()
+        self.assertEqual(flights.stats(), {'calls': 2, 'coalesced': 1, 'in_flight': 0})
+
+
+
+class BreakerTest(unittest.TestCase):
+    def test_cancelled_trial(self):
+        class Cancelling(object):
+            def open(self, url, timeout=None):
+                job.cancel()
+                raise socket.error('reset by peer')
+
+        source = Mathscinet(Cancelling())
+        source.breakers = BreakerRegistry(threshold=1, cooldown=0)
+        breaker = source.breakers.get('host')
+        breaker.record_failure()
+
+        job = QueryJob({}, timeout=5)
+        self.assertRaises(NetbibCancelled, source.fetch_url, 'http://host/', job)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # The next request is a new trial, and closes the breaker
+        cassette = Cassette()
+        cassette.add('http://host/', b'ok')
+        source.browser = ReplayBrowser(cassette)
+        source.local = threading.local()
+        self.assertEqual(source.fetch_url('http://host/', QueryJob({})), b'ok')
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+
+
+class ConverterTest(unittest.TestCase):
+    def test_math_with_less_than(self):
+        page = ('<div class="review">first <span class="MathTeX"><script type="math/tex">'
+                'a<b</script></span> second<br/>&nbsp;&nbsp;end</div>')
+        self.assertEqual(review(page), '<p>first second</p>\n<p>end</p>')
+        self.assertEqual(review(page.encode('utf-8')), '<p>first second</p>\n<p>end</p>')
+
+
+    def test_unclosed(self):
+        self.assertIsNone(review('<div class="review">first <script type="math/tex">a<b'))
+
+
+
+
+class BibtexTest(unittest.TestCase):
+    bibtex = ('% Papers\n@string{ams = {American Mathematical Society}}\n\n'
+              '@article{a,\n  title = {On {T}hings},\n}\nSee also me@example.org\n'
+              '@comment{nothing here}\n@book{b, title = {Other}}\n')
+
+    def test_pieces(self):
+        for size in [1, 7, 1000]:
+            pieces = list(iter_bibtex(io.StringIO(self.bibtex), size, text=True))
+            self.assertEqual(''.join(p for kind, p in pieces), self.bibtex)
+            self.assertEqual([p for kind, p in pieces if kind == 'entry'],
+                             chop_bibtex(self.bibtex))
+
+
+    def test_enrich_stream(self):
+        class Marker(object):
+            def enrich(self, raw):
+                if not raw.startswith('@article'): return raw, []
+                return raw.replace('}\n}', '},\n  note = {x}\n}'), ['note']
+
+        done = []
+        pieces = iter_bibtex(io.StringIO(self.bibtex), 16, text=True)
+        out = ''.join(enrich_stream(pieces, Marker(), 2, done.append))
+        self.assertEqual(out, self.bibtex.replace('}\n}', '},\n  note = {x}\n}'))
+        self.assertEqual(done, [[], ['note'], [], []])
+
+
+
+
+class EnricherTest(unittest.TestCase):
+    """The answers the cli takes, replaying the mathscinet fixture"""
+
+    def setUp(self):
+        self.cassette = Cassette.load(os.path.join(fixtures, 'mathscinet.json'))
+        self.source = Mathscinet(ReplayBrowser(self.cassette))
+        self.source.xref = IdentifierMap()
+        self.source.sleep_time = 0
+        self.enricher = Enricher({'mathscinet': self.source}, abstracts=False)
+
+
+    def tearDown(self):
+        self.source.xref.close()
+
+
+    def answer(self, query, like):
+        """Serves the recorded answer to the search like as the answer to query"""
+        url = lambda d: '%s?%s' % (self.source.url, urlencode(self.source.format_query(d)))
+        self.cassette.add(url(query), self.cassette.body(self.cassette.get(url(like))))
+
+
+    def test_doi_answer(self):
+        # MathSciNet searches for the doi anywhere, so it may find another paper
+        self.answer({'doi': '10.1000/other.1'}, {'authors': ['Perez']})
+        bib = {'bibtextype': 'article', 'doi': '10.1000/other.1'}
+        self.assertEqual(self.enricher.lookup(bib, ['mathscinet']), ({'mathscinet': []}, {}))
+
+        self.answer({'doi': 'https://doi.org/10.1000/Synthetic.0'}, {'authors': ['Perez']})
+        bib = {'bibtextype': 'article', 'doi': 'https://doi.org/10.1000/Synthetic.0'}
+        found, errors = self.enricher.lookup(bib, ['mathscinet'])
+        self.assertIn(('mrnumber', '2000000'), found['mathscinet'])
+
+
+    def test_xref_answer(self):
+        self.source.xref_distance = 1.       # Leave the check to the enricher
+        self.source.xref.add({'zbl': '5555.55555', 'mr': '2000000'})
+        bib = {'bibtextype': 'article', 'zbl': '5555.55555', 'title': 'Another paper',
+               'author': 'Nobody, Anne'}
+        found, errors = self.enricher.lookup(bib, ['mathscinet'])
+        self.assertEqual(found, {'mathscinet': []})
+
+
+    def test_resume(self):
+        raw = ('@article{perez,\n'
+               '  title = {%s},\n'
+               '  author = {P\\\'erez, Stanis{\\l}aw and Serre, Maxim},\n'
+               '}' % ReplayTest.title)
+        bib = parse_bibtex_entry(raw)
+        self.answer(self.enricher.entry_query(bib, self.source), {'authors': ['Perez']})
+
+        failing = Mathscinet(ReplayBrowser(Cassette()))
+        failing.xref = self.source.xref
+        journal = Journal()
+        key = query_key(dict((k, v) for k, v in self.enricher.entry_query(bib, failing).items()
+                             if k != 'id'), ['mathscinet'])
+
+        # A failed entry is recorded, and retried on the next run
+        enricher = Enricher({'mathscinet': failing}, abstracts=False, journal=journal)
+        self.assertEqual(enricher.enrich(raw), (raw, []))
+        self.assertEqual(journal.get(key)['status'], Journal.FAILED)
+
+        enricher = Enricher({'mathscinet': self.source}, abstracts=False, journal=journal)
+        out, fields = enricher.enrich(raw)
+        self.assertEqual(fields, ['mrnumber', 'mrclass', 'doi'])
+        self.assertEqual(journal.get(key)['status'], Journal.DONE)
+        self.assertEqual(journal.get(key)['attempts'], 2)
+
+        # A done entry is not looked up again, and gives the same output
+        enricher = Enricher({'mathscinet': failing}, abstracts=False, journal=journal)
+        self.assertEqual(enricher.enrich(raw), (out, fields))
+        self.assertEqual(journal.get(key)['attempts'], 2)
+        self.assertEqual(out, self.enricher.enrich(raw)[0])
+
+
+
+
+class EnrichAbstractsTest(unittest.TestCase):
+    """Abstract enrichment, replaying the zbmath fixture with some latency"""
+
+    def source(self, latency, enrich_timeout):
+        cassette = Cassette.load(os.path.join(fixtures, 'zbmath.json'))
+        source = Zentralblatt(ReplayBrowser(cassette, latency=latency))
+        source.enrich_timeout = enrich_timeout
+        return source
+
+
+    def test_abstract(self):
+        ans = [{'id': '1000.10000'}]
+        self.source(0.1, 5).enrich(ans, QueryJob({}))
+        self.assertTrue(ans[0]['abstract'].startswith('<p>surfaces sheaves motivic Langlands'))
+
+
+    def test_skip_late_abstract(self):
+        ans = [{'id': '1000.10000'}]
+        start = time.time()
+        self.source(1, 0.2).enrich(ans, QueryJob({}))
+        self.assertLess(time.time() - start, 0.8)
+        self.assertFalse('abstract' in ans[0])
+
+
+    def test_deadline(self):
+        ans = [{'id': '1000.10000'}]
+        start = time.time()
+        self.source(1, 5).enrich(ans, QueryJob({}, deadline=time.time() + 0.2))
+        self.assertLess(time.time() - start, 0.8)
+        self.assertFalse('abstract' in ans[0])
+
+
+    def test_cancel(self):
+        # The fetch pool is busy, so the request waits in its queue out of reach of
+        # the token. Cancelling still ends the wait at once.
+        source = self.source(0, 10)
+        source.fetch_pool = WorkerPool(size=1, name='netbib-test')
+        busy = threading.Event()
+        source.fetch_pool.submit(Job(), busy.wait, 5)
+
+        ans = [{'id': '1000.10000'}]
+        job = QueryJob({})
+        threading.Timer(0.2, job.cancel).start()
+
+        start = time.time()
+        try:
+            self.assertRaises(NetbibCancelled, source.enrich, ans, job)
+            self.assertLess(time.time() - start, 2)
+        finally:
+            busy.set()
+        self.assertFalse('abstract' in ans[0])
+
+
+
+
+class RecordTest(unittest.TestCase):
+    def test_mapping(self):
+        r = Record({'id': '2000000'}, title='A title')
+        r['authors'] = ['Maxim Serre', 'Stanislaw Perez']
+        r['mrclass'] = '81T30'
+
+        self.assertEqual(r['authors'], ('Maxim Serre', 'Stanislaw Perez'))
+        self.assertEqual(r.keys(), ['id', 'title', 'authors', 'mrclass'])
+        self.assertEqual(len(r), 4)
+        self.assertTrue('mrclass' in r)
+        self.assertFalse('abstract' in r)
+        self.assertRaises(KeyError, lambda: r['abstract'])
+        self.assertRaises(KeyError, lambda: r['note'])
+        self.assertEqual(r.get('abstract', 'none'), 'none')
+        self.assertEqual(r, {'id': '2000000', 'title': 'A title', 'mrclass': '81T30',
+                             'authors': ('Maxim Serre', 'Stanislaw Perez')})
+
+        self.assertEqual(r.setdefault('doi', '10.1000/synthetic.0'), '10.1000/synthetic.0')
+        self.assertEqual(r.setdefault('doi', 'other'), '10.1000/synthetic.0')
+        self.assertEqual(r.pop('mrclass'), '81T30')
+        self.assertEqual(r.pop('mrclass', None), None)
+        del r['title']
+        self.assertRaises(KeyError, r.__delitem__, 'title')
+        self.assertEqual(sorted(r.keys()), ['authors', 'doi', 'id'])
+
+
+    def test_lazy(self):
+        calls = []
+        def upper(txt):
+            calls.append(txt)
+            return txt.upper()
+
+        r = Record(id='1', title=Lazy(upper, 'a title'), note=Lazy(upper, 'a note'))
+        self.assertEqual(calls, [])
+        self.assertEqual(r['title'], 'A TITLE')
+        self.assertEqual(r['title'], 'A TITLE')
+        self.assertEqual(calls, ['a title'])
+        self.assertEqual(dict(r.items()), {'id': '1', 'title': 'A TITLE', 'note': 'A NOTE'})
+        self.assertEqual(calls, ['a title', 'a note'])
+
+
+    def test_copy(self):
+        calls = []
+        def upper(txt):
+            calls.append(txt)
+            return txt.upper()
+
+        r = Record(id='1', title=Lazy(upper, 'a title'), note='x')
+        c = r.copy()
+        c['note'] = 'y'
+        c['id'] = '2'
+        self.assertEqual((r['id'], r['note']), ('1', 'x'))
+
+        # Copies keep fields that are not computed yet lazy, and compute them on their own
+        self.assertEqual(calls, [])
+        self.assertEqual(c['title'], 'A TITLE')
+        self.assertEqual(r['title'], 'A TITLE')
+        self.assertEqual(calls, ['a title', 'a title'])
+
+        self.assertEqual(pickle.loads(pickle.dumps(r)), r)
+
+
+
+
+class TagsTest(unittest.TestCase):
+    """The compiled tag tables give the same tags as the old lookup"""
+
+    def setUp(self):
+        try:
+            import tags
+        except ImportError:
+            self.skipTest('tags is not importable, run from the libs directory')
+        self.tags = tags
+
+
+    def test_msc_tags(self):
+        table = self.tags._msc_tags
+        classes = set(re.match('[0-9]+', k).group(0) for k in table) | set(['00', '99'])
+        letters = set(re.sub('[0-9]', '', k) for k in table) | set(['Z'])
+        codes = ['%s%s%02d' % (c, l, n) for c in classes for l in letters if l
+                 for n in range(0, 100)]
+        codes.extend(['14', '14B', '5A1', '014B05', 'math.AG', ''])
+
+        self.assertGreater(len(codes), 10000)
+        for code in codes:
+            self.assertEqual(self.tags.msc_tags(code), legacy_msc_tags(table, code), code)
+
+
+    def test_subject_tags(self):
+        codes = msc_codes() + list(self.tags._arxiv_tags.keys())
+        for i in range(0, len(codes), 3):
+            subjects = codes[i:i+3]
+            self.assertEqual(self.tags.subject_tags(subjects),
+                             legacy_subject_tags(self.tags, subjects), subjects)
+
+
+
+
+class ReplayTest(unittest.TestCase):
+    """Replays the cassettes left in fixtures by 'make fixtures' through the sources"""
+
+    title = ('Correspondence Poisson the Langlands integration theory K-theory categories '
+             'note categories surfaces stacks')
+    authors = ('Stanisław Pérez', 'Maxim Serre')
+
+    def replay(self, cls, name):
+        cassette = Cassette.load(os.path.join(fixtures, '%s.json' % name))
+        source = cls(ReplayBrowser(cassette))
+
+        ans = source.get_matches(source.format_query({'authors': ['Perez']}), QueryJob({}))
+        self.assertEqual(len(ans), 1)
+        self.assertEqual(ans[0]['title'], self.title)
+        self.assertEqual(tuple(ans[0]['authors']), self.authors)
+        self.assertEqual(ans[0]['doi'], '10.1000/synthetic.0')
+
+        item = source.get_item(ans[0]['id'], QueryJob({}))
+        self.assertEqual(item['id'], ans[0]['id'])
+        self.assertEqual(item['title'], self.title)
+
+        abstract = source.get_abstract(ans[0]['id'], QueryJob({}))
+        self.assertTrue(abstract.startswith('<p>surfaces sheaves motivic Langlands'))
+        return ans[0]
+
+
+    def test_arxiv(self):
+        d = self.replay(Arxiv, 'arxiv')
+        self.assertEqual(d['id'], '1001.00000v1')
+        self.assertEqual(d['subject'], ['math.AT', 'math.CT'])
+
+
+    def test_mathscinet(self):
+        d = self.replay(Mathscinet, 'mathscinet')
+        self.assertEqual(d['id'], '2000000')
+        self.assertEqual(d['journal'], 'Inventiones Mathematicae')
+        self.assertEqual(d['subject'], ['81T30'])
+
+
+    def test_zentralblatt(self):
+        d = self.replay(Zentralblatt, 'zbmath')
+        self.assertEqual(d['id'], '1000.10000')
+        self.assertEqual(d['publisher'], 'Springer')
+        self.assertEqual(d['subject'], ['81T30'])
+
+
+
+
+class XrefTest(unittest.TestCase):
+    """The cross reference map, and the plans it gives to the zbmath source"""
+
+    title = ReplayTest.title
+    authors = list(ReplayTest.authors)
+
+    def setUp(self):
+        self.cassette = Cassette.load(os.path.join(fixtures, 'zbmath.json'))
+        self.xref = IdentifierMap()
+        self.source = Zentralblatt(ReplayBrowser(self.cassette))
+        self.source.xref = self.xref
+        self.source.sleep_time = 0
+
+
+    def tearDown(self):
+        self.xref.close()
+
+
+    def test_lookup(self):
+        self.xref.add({'mr': 'MR2000000', 'zbl': '1000.10000',
+                       'doi': 'https://doi.org/10.1000/Synthetic.0'})
+        self.assertEqual(self.xref.lookup({'mr': '2000000'}),
+                         {'mr': '2000000', 'zbl': '1000.10000', 'doi': '10.1000/synthetic.0'})
+        self.assertEqual(self.xref.lookup({'arxiv': '1001.00000'}), {})
+
+
+    def test_isbn_does_not_join(self):
+        self.xref.add({'mr': '1111', 'zbl': '1000.10000', 'isbn': '978-3-16-148410-0'})
+        self.xref.add({'mr': '2222', 'isbn': '978-3-16-148410-0'})
+        self.assertEqual(self.xref.lookup({'mr': '2222'}), {})
+
+        plans = self.source.plan_query({'mr': '2222', 'authors': ['Perez']})
+        self.assertEqual([plan for plan, query in plans], ['strict'])
+
+
+    def test_ambiguous(self):
+        self.xref.add({'mr': '1111', 'zbl': '1000.10000'})
+        self.xref.add({'arxiv': '1001.00000', 'doi': '10.1000/a'})
+        self.xref.add({'mr': '3333', 'doi': '10.1000/b'})
+        self.xref.add({'mr': '4444', 'doi': '10.1000/b'})
+
+        # Different clusters, a value other than the query's, two values in a cluster
+        self.assertEqual(self.xref.lookup({'mr': '1111', 'arxiv': '1001.00000'}), {})
+        self.assertEqual(self.xref.lookup({'mr': '2222', 'zbl': '1000.10000'}), {})
+        self.assertEqual(self.xref.lookup({'mr': '3333'}), {})
+
+
+    def test_plans(self):
+        self.xref.add({'mr': '2000000', 'zbl': '1000.10000', 'doi': '10.1000/synthetic.0'})
+        plans = self.source.plan_query({'mr': '2000000', 'authors': ['Perez']})
+        self.assertEqual(plans, [('xref', {'id': '1000.10000'}),
+                                 ('doi', {'doi': '10.1000/synthetic.0'}),
+                                 ('strict', {'authors': ['Perez']})])
+
+
+    def test_xref_answer(self):
+        self.xref.add({'mr': '2000000', 'zbl': '1000.10000'})
+        job = QueryJob({'mr': '2000000', 'title': self.title, 'authors': self.authors})
+        ans = self.source.get_answer(job)
+        self.assertEqual(job.plan, 'xref')
+        self.assertEqual([d['id'] for d in ans], ['1000.10000'])
+
+
+    def test_xref_answer_far_from_query(self):
+        self.xref.add({'mr': '1111', 'zbl': '1000.10000'})
+        job = QueryJob({'mr': '1111', 'authors': ['Perez']})
+        ans = self.source.get_answer(job)
+        self.assertEqual(job.plan, 'strict')
+        self.assertIn('xref', job.stats.timings())
+        self.assertEqual([d['id'] for d in ans], ['1000.10000'])
+
+
+    def test_failed_plan(self):
+        self.cassette.add('https://zbmath.org/bibtex/9999.99999.bib', b'', status=404)
+        self.xref.add({'mr': '5555', 'zbl': '9999.99999'})
+        job = QueryJob({'mr': '5555', 'authors': ['Perez']})
+        ans = self.source.get_answer(job)
+        self.assertEqual(job.plan, 'strict')
+        self.assertIn('xref', job.stats.failures)
+        self.assertEqual([d['id'] for d in ans], ['1000.10000'])
+
+        # With no other plan to fall back on, the error is raised
+        job = QueryJob({'id': '9999.99999'})
+        self.assertRaises(HTTPError, self.source.get_answer, job)
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
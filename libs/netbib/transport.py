@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+if sys.version_info[0] >= 3:
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+    from urllib.request import HTTPHandler, HTTPSHandler
+    from urllib.request import build_opener as urllib_build_opener
+    from http.client import HTTPConnection, HTTPSConnection
+else:
+    from urlparse import urlsplit, urlunsplit, parse_qsl
+    from urllib import urlencode
+    from urllib2 import HTTPHandler, HTTPSHandler
+    from urllib2 import build_opener as urllib_build_opener
+    from httplib import HTTPConnection, HTTPSConnection
+
+from .jobs import Job
+from .errors import NetbibCancelled, NetbibDeadline
+
+
+
+class SingleFlight(object):
+    """Coalesces identical concurrent calls. While a call for some key is in flight,
+       further calls with the same key wait for it and share its outcome instead of
+       doing the work again."""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+
+    def do(self, key, fn, token=None, timeout=None):
+        """Runs fn(), or waits for the call in flight with the same key. Returns a pair
+           with the answer and whether it was shared with another call."""
+        with self.lock:
+            self.calls = self.calls + 1
+
+        joined = False
+        while True:
+            with self.lock:
+                flight = self.flights.get(key, None)
+                leader = flight is None
+                if leader:
+                    flight = Job()
+                    self.flights[key] = flight
+                elif not joined:
+                    self.coalesced = self.coalesced + 1
+                    joined = True
+
+            if leader:
+                try:
+                    flight.run(fn)
+                finally:
+                    with self.lock:
+                        del self.flights[key]
+
+                if flight.error: raise flight.error
+                return flight.ans, False
+
+            self.wait(flight, token, timeout)
+
+            # The leader gave up for its own reasons, try again on our own
+            if isinstance(flight.error, (NetbibCancelled, NetbibDeadline)):
+                continue
+
+            if flight.error: raise flight.error
+            return flight.ans, True
+
+
+    def wait(self, flight, token, timeout):
+        """Waits for a call in flight, giving up if the token is cancelled or on timeout"""
+        wake = threading.Event()
+        flight.add_done_callback(lambda job: wake.set())
+        if token: token.add_callback(wake.set)
+
+        try:
+            wake.wait(timeout)
+        finally:
+            if token: token.remove_callback(wake.set)
+
+        if token and token.is_cancelled():
+            raise NetbibCancelled("Query cancelled")
+
+        if not flight.is_done():
+            raise NetbibDeadline("Query deadline exceeded")
+
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls,
+                    'coalesced': self.coalesced,
+                    'in_flight': len(self.flights)}
+
+
+
+class ResponseCache(object):
+    """Keeps the most recent size response bodies in memory, keyed by canonical url.
+       Entries older than ttl seconds are dropped, if ttl is given."""
+
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (self.ttl is not None and time.time() - entry[0] > self.ttl):
+                self.misses = self.misses + 1
+                return None
+
+            self.entries[key] = entry
+            self.hits = self.hits + 1
+            return entry[1]
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self.entries)}
+
+
+
+def canonical_url(url):
+    """Normalizes an url so that equivalent requests compare equal"""
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/',
+                       query, ''))
+
+
+
+def read_response(resp, token, chunk_size=65536, sink=None, deadline=None):
+    """Reads a response body in chunks, passing each one to sink.feed if given. While
+       reading, cancelling the token aborts the response. Returns the body, or None if
+       cancelled. Raises NetbibDeadline if the deadline, a time.time() value, passes
+       before the body is complete."""
+    abort = lambda: abort_response(resp)
+    token.add_callback(abort)
+
+    chunks = []
+    try:
+        while not token.is_cancelled():
+            if deadline is not None and time.time() >= deadline:
+                abort_response(resp)
+                raise NetbibDeadline("Query deadline exceeded while reading the response")
+
+            buf = resp.read(chunk_size)
+            if not buf: break
+            chunks.append(buf)
+            if sink: sink.feed(buf)
+
+    except Exception:
+        if not token.is_cancelled(): raise
+
+    finally:
+        token.remove_callback(abort)
+
+    if token.is_cancelled(): return None
+    return b''.join(chunks)
+
+
+@contextmanager
+def abortable(token, connect_timeout=None):
+    """Within the block, the connections opened by this thread through the opener from
+       build_opener are aborted when token is cancelled, from the moment their socket is
+       created. This covers the time spent connecting and waiting for the response
+       headers, before read_response takes over. Connecting takes at most
+       connect_timeout seconds, if given."""
+    scope = (token, connect_timeout, [])
+    _local.scope = scope
+    try:
+        yield
+    finally:
+        _local.scope = None
+        for abort in scope[2]:
+            token.remove_callback(abort)
+
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """socket.create_connection, registering the socket with the token of the abortable
+       block the thread is in, if any"""
+    scope = getattr(_local, 'scope', None)
+    if scope is None:
+        return socket.create_connection(address, timeout, source_address)
+
+    token, connect_timeout, aborts = scope
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT: timeout = socket.getdefaulttimeout()
+    if connect_timeout is None or (timeout is not None and timeout < connect_timeout):
+        connect_timeout = timeout
+
+    host, port = address
+    err = None
+    for af, socktype, proto, canonname, sa in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        sock = socket.socket(af, socktype, proto)
+        abort = abort_socket(sock)
+        aborts.append(abort)
+        token.add_callback(abort)
+        try:
+            sock.settimeout(connect_timeout)
+            if source_address: sock.bind(source_address)
+            sock.connect(sa)
+            sock.settimeout(timeout)
+            return sock
+
+        except socket.error as e:
+            err = e
+            sock.close()
+
+    if err is not None: raise err
+    raise socket.error('getaddrinfo returns an empty list')
+
+
+
+class AbortableHTTPConnection(HTTPConnection):
+    """HTTPConnection whose socket can be aborted from an abortable block"""
+
+    def __init__(self, *args, **kwargs):
+        HTTPConnection.__init__(self, *args, **kwargs)
+        self._create_connection = create_connection
+
+
+
+class AbortableHTTPSConnection(HTTPSConnection):
+    """HTTPSConnection whose socket can be aborted from an abortable block"""
+
+    def __init__(self, *args, **kwargs):
+        HTTPSConnection.__init__(self, *args, **kwargs)
+        self._create_connection = create_connection
+
+
+
+class AbortableHTTPHandler(HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(AbortableHTTPConnection, req)
+
+
+
+class AbortableHTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(AbortableHTTPSConnection, req, context=self._context)
+
+
+
+def build_opener(*handlers):
+    """urllib's build_opener, with http and https connections that abortable blocks can
+       reach before there is a response. The handlers are added as in urllib."""
+    return urllib_build_opener(AbortableHTTPHandler, AbortableHTTPSHandler, *handlers)
+
+
+
+def abort_socket(sock):
+    """Returns a function that aborts sock, which may be blocked on another thread"""
+    def abort():
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError): pass
+        try: sock.close()
+        except (socket.error, OSError): pass
+    return abort
+
+
+def abort_response(resp):
+    """Aborts a response that may be blocked in a read on another thread. Shuts down
+       the underlying socket if it can be found, and closes the response."""
+    sock = find_socket(resp)
+    if sock:
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError): pass
+
+    try: resp.close()
+    except Exception: pass
+
+
+def find_socket(obj, depth=0):
+    """Digs the socket out of the wrappers around a urllib or mechanize response."""
+    if isinstance(obj, socket.socket): return obj
+    if obj is None or depth > 6: return None
+
+    for attr in ['wrapped', 'fp', 'raw', '_sock', 'sock']:
+        sock = find_socket(getattr(obj, attr, None), depth+1)
+        if sock: return sock
+
+    return None
+
+
+
+flights = SingleFlight()
+
+# The abortable block each thread is in, read by create_connection
+_local = threading.local()
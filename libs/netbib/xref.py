@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# netbib - collect bibliographical data over the net
+# Copyright 2012 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (unicode_literals, division)
+
+import re
+import sqlite3
+import threading
+
+
+
+class IdentifierMap(object):
+    """Cross reference of the identifiers of a paper in different sources: arxiv, mr,
+       zbl and doi. Identifiers seen together in a record are grouped in a cluster, so
+       that knowing any of them gives all the others. Only identifiers of a single paper
+       take part, an isbn is shared by all the papers of a book. Kept in an sqlite
+       database at path, or in memory if path is None."""
+
+    schemes = ['arxiv', 'mr', 'zbl', 'doi']
+
+    def __init__(self, path=None):
+        self.path = path or ':memory:'
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS ids ("
+                        "  scheme TEXT NOT NULL,"
+                        "  value TEXT NOT NULL,"
+                        "  cluster INTEGER NOT NULL,"
+                        "  PRIMARY KEY (scheme, value))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS ids_cluster ON ids (cluster)")
+        self.db.commit()
+
+
+
+    # Public interface
+    # ------------------------------ #
+
+    def add(self, ids):
+        """Records that the identifiers in the dictionary ids, keyed by scheme, belong to
+           the same paper."""
+        pairs = self.normalize(ids)
+        if len(pairs) < 2: return
+
+        with self.lock:
+            clusters = self.find_clusters(pairs)
+
+            if len(clusters) == 0:
+                row = self.db.execute("SELECT COALESCE(MAX(cluster), 0) + 1 FROM ids").fetchone()
+                cluster = row[0]
+            else:
+                cluster = clusters[0]
+                for other in clusters[1:]:
+                    self.db.execute("UPDATE ids SET cluster = ? WHERE cluster = ?",
+                                    (cluster, other))
+
+            self.db.executemany("INSERT OR IGNORE INTO ids (scheme, value, cluster) "
+                                "VALUES (?, ?, ?)",
+                                [(k, v, cluster) for k, v in pairs])
+            self.db.commit()
+
+
+    def lookup(self, ids):
+        """Returns a dictionary with all known identifiers of the paper with the given
+           identifiers, keyed by scheme. Returns an empty dictionary if the identifiers
+           belong to different clusters, or if they disagree on the value for some
+           scheme, since then there is no telling which paper is meant."""
+        pairs = self.normalize(ids)
+        if len(pairs) == 0: return {}
+
+        with self.lock:
+            clusters = self.find_clusters(pairs)
+            if len(clusters) != 1: return {}
+
+            ans = dict(pairs)
+            for scheme, value in self.db.execute(
+                    "SELECT scheme, value FROM ids WHERE cluster = ?", (clusters[0],)):
+                if ans.setdefault(scheme, value) != value: return {}
+
+        return ans
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+
+    # Internals
+    # ------------------------------ #
+
+    def find_clusters(self, pairs):
+        clusters = set()
+        for scheme, value in pairs:
+            row = self.db.execute("SELECT cluster FROM ids WHERE scheme = ? AND value = ?",
+                                  (scheme, value)).fetchone()
+            if row: clusters.add(row[0])
+        return sorted(clusters)
+
+
+    def normalize(self, ids):
+        """Returns a list of (scheme, value) pairs with normalized values"""
+        pairs = []
+        for scheme in self.schemes:
+            value = ids.get(scheme, None)
+            if not value: continue
+
+            value = value.strip()
+            if scheme == 'doi':
+                value = normalize_doi(value)
+            elif scheme == 'mr':
+                value = re.sub('^MR', '', value.upper()).strip()
+
+            if value: pairs.append((scheme, value))
+
+        return pairs
+
+
+
+def normalize_doi(doi):
+    """Returns doi in lower case, without the resolver url or doi: prefix"""
+    return re.sub('^(https?://(dx\.)?doi\.org/|doi:)', '', doi.strip().lower())
+
+
+
+_maps = {}
+_maps_lock = threading.Lock()
+
+def get_map(path=None):
+    """Returns the identifier map stored at path, shared by all its users"""
+    with _maps_lock:
+        if not path in _maps:
+            _maps[path] = IdentifierMap(path)
+        return _maps[path]
@@ -31,8 +31,15 @@ else:
 
 from .latex_encoding import latex_decode
 from .utils import surname, metadata_distance
-from .bibtexparser import parse_bibtex
 from .base import NetbibBase, NetbibError
+from .abstract import Converter
+
+bibtex_link = re.compile(b'"bibtex/(.*).bib"')
+
+# The abstract is in paragraphs separated by blank lines. Some documents have a scan
+# of the review instead.
+abstract = Converter('<div class="abstract">', '\n\s*?\n', reject=[('div', 'class="scan"')])
+
 
 class ZentralblattError(NetbibError):
     pass
@@ -42,7 +49,7 @@ class Zentralblatt(NetbibBase):
     def __init__(self, browser, timeout=30):
         super(Zentralblatt, self).__init__()
 
-        self.search_fields = ['title', 'authors', 'id']
+        self.search_fields = ['title', 'authors', 'id', 'doi']
         self.idkey = 'zbl'
 
         self.timeout = timeout
@@ -51,7 +58,6 @@ class Zentralblatt(NetbibBase):
 
         self.url_bibtex = "https://zbmath.org/bibtex"
         self.url_query = "https://zbmath.org"
-        self.ans = []
 
 
 
@@ -70,56 +76,63 @@ class Zentralblatt(NetbibBase):
         return d
 
 
-    def get_item(self, bibid):
+    def get_item(self, bibid, job):
+        return self.shared(('zentralblatt-item', bibid), job, self.fetch_item, bibid, job)
+
+
+    def fetch_item(self, bibid, job):
         query = '%s/%s.bib' % (self.url_bibtex, bibid)
-        raw = self.browser.open(query, timeout=self.timeout).read()
-        rawdata=raw.decode('utf-8', errors='replace').strip()
+        raw = self.fetch(query, job)
+        rawdata = self.decode(raw, job)
 
-        ans = parse_bibtex(rawdata)
+        ans = self.parse_bibtex(rawdata, job)
 
         if len(ans) > 0:
-            return self.entry_from_bibtex(ans[0])
+            return ans[0]
 
         return None
 
 
-    def get_abstract(self, bibid):
+    def get_abstract(self, bibid, job):
         """Returns the answer to a query"""
         params = self.format_query({'id': bibid})
         query = '%s?%s' % (self.url_query, urlencode(params))
-        raw = self.browser.open(query, timeout=self.timeout).read()
-        rawdata=raw.decode('utf-8', errors='replace').strip()
-        m = re.search('<div class="abstract">(.*?)</div>', rawdata, re.DOTALL)
-        if m:
-            abstract = m.group(1).strip()
+        raw = self.fetch(query, job)
 
-            # The abstract section might contain crap
-            if '<div class="scan">' in abstract: return None
+        with job.stage('extract'):
+            return self.extract_abstract(raw)
 
-            L = re.findall("(.*?)\n\s*?\n", abstract + "\n\n", re.DOTALL | re.MULTILINE)
-            Lpar = [self.format_abstract_paragraph(par.strip()) for par in L if len(par.strip()) > 0]
-            abstract = ('\n'.join(Lpar)).strip()
 
-            if len(abstract) > 0:
-                return abstract
-
-        return None
+    def extract_abstract(self, rawdata):
+        """Extracts the abstract or review from a document page as html paragraphs"""
+        return abstract(rawdata)
 
 
-    def get_matches(self, params):
+    def get_matches(self, params, job):
         query = '%s?%s' % (self.url_query, urlencode(params))
-        raw = self.browser.open(query, timeout=self.timeout).read()
-        rawdata=raw.decode('utf-8', errors='replace').strip()
+        raw = self.fetch(query, job)
+
+        with job.stage('extract'):
+            bibids = self.extract_bibids(raw)
 
         ans = []
-        # note, we are not catching the id's, just some wat to retrieve the bibtex!
-        for bibid in re.findall('"bibtex/(.*).bib"', rawdata):
-            item = self.get_item(bibid)
-            if item: ans.append(item)
+        for bibid in bibids:
+            self.check_cancelled(job)
+            item = self.get_item(bibid, job)
+            if item:
+                job.provide(item)
+                ans.append(item)
 
         return ans
 
 
+    def extract_bibids(self, raw):
+        """Returns the ids in the bibtex links of a results page, looked up in the raw
+           response"""
+        # note, we are not catching the id's, just some wat to retrieve the bibtex!
+        return [b.decode('utf-8', 'replace') for b in bibtex_link.findall(raw)]
+
+
     def format_query(self, d, lax=False):
         """Formats a query suitable to send to Zentralblatt API"""
         for k in d.keys():
@@ -130,6 +143,9 @@ class Zentralblatt(NetbibBase):
         if 'id' in d.keys():
             items.append('an:%s' % d['id'])
 
+        elif 'doi' in d.keys():
+            items.append('en:%s' % d['doi'])
+
         elif 'authors' in d.keys() or 'title' in d.keys():
             if 'title' in d.keys():
                 if lax: items.append('any:' + ('"%s"' % d['title']))
@@ -145,12 +161,3 @@ class Zentralblatt(NetbibBase):
 
         params = {'q': ' '.join(items)}
         return params
-
-
-    # Utility stuff
-    # ------------------------------ #
-
-    def format_abstract_paragraph(self, par):
-        par = re.sub('\s+', ' ', par)
-
-        return '<p>%s</p>' % par.strip()
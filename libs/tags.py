@@ -651,21 +651,83 @@ _msc_tags = {
 
 
 def arxiv_tags(subj):
-    return _arxiv_tags.get(subj, [])
+    return _arxiv_sets.get(subj, _empty)
 
 
 def msc_tags(subj):
+    """Returns the frozenset of tags for an MSC code, like 14B05, from all its levels"""
+    try:
+        return _msc_cache[subj]
+    except KeyError:
+        pass
+
+    tags = _empty
+    m = _msc_code.match(subj)
+    if m:
+        node = _msc_tree.get('%02d' % int(m.group(1)))
+        if node:
+            tags = node[0]
+            node = node[1].get(m.group(2))
+            if node:
+                tags = tags | node[0]
+                node = node[1].get('%02d' % int(m.group(3)))
+                if node: tags = tags | node[0]
+
+    if len(_msc_cache) >= _cache_size: _msc_cache.clear()
+    _msc_cache[subj] = tags
+    return tags
+
 
+def subject_tags(subjects):
+    """Returns the frozenset of msc and arxiv tags for a list of subject codes"""
     tags = set()
-    m = re.match('([0-9]+)([A-Z]+)([0-9]+)', subj)
+    for subj in subjects:
+        tags.update(msc_tags(subj))
+        tags.update(_arxiv_sets.get(subj, _empty))
+    return frozenset(tags)
 
-    if m:
-        level1 = '%02d'   % int(m.group(1))
-        level2 = '%s%s'   % (level1, m.group(2))
-        level3 = '%s%02d' % (level2, int(m.group(3)))
 
-        tags.update(_msc_tags.get(level1, []))
-        tags.update(_msc_tags.get(level2, []))
-        tags.update(_msc_tags.get(level3, []))
 
-    return tags
+
+# Compiled tables                                                     #
+# ------------------------------------------------------------------- #
+
+# The msc tags are kept in a tree by level: two digits, letter and two more digits. A
+# node is a pair with the frozenset of tags at that level and the dict of its children.
+# Tag strings are interned, so that the sets of all levels share them.
+
+try:
+    from sys import intern
+except ImportError:
+    pass                # Python 2 has intern as a builtin
+
+_msc_code = re.compile('([0-9]+)([A-Z]+)([0-9]+)')
+_empty = frozenset()
+_cache_size = 8192
+_msc_cache = {}
+
+
+def _tagset(tags):
+    return frozenset(intern(str(t)) for t in tags)
+
+
+def _compile_msc(table):
+    tree = {}
+    for code, tags in table.items():
+        m = re.match('([0-9]+)([A-Z]*)([0-9]*)$', code)
+        levels = ['%02d' % int(m.group(1))]
+        if m.group(2): levels.append(m.group(2))
+        if m.group(3): levels.append('%02d' % int(m.group(3)))
+
+        node = None
+        children = tree
+        for level in levels:
+            node = children.setdefault(level, [_empty, {}])
+            children = node[1]
+        node[0] = node[0] | _tagset(tags)
+
+    return tree
+
+
+_msc_tree = _compile_msc(_msc_tags)
+_arxiv_sets = dict((code, _tagset(tags)) for code, tags in _arxiv_tags.items())